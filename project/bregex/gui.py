@@ -1,6 +1,7 @@
 from tkinter import *
 from tkinter import ttk
 from tkinter import messagebox
+from tkinter import filedialog
 import re
 import platform
 import sys
@@ -26,6 +27,8 @@ files_g = None
 finder_g = None
 prev_finder_g = None
 replacer_g = None
+watcher_g = None
+journal_g = None
 
 unselected_files = []
 
@@ -54,7 +57,10 @@ def open_file():
     
     def apply():
         global files_g
+        global watcher_g
+        global journal_g
         files_g = regex.Files()
+        journal_g = None
         for x in t.get_children():
             vals = t.item(x)["values"]
             if vals[2] == "True":
@@ -73,6 +79,9 @@ def open_file():
             if res[1]:
                 messagebox.showerror(title="Error", message=f"Some files ({len(res[1])}) in path '{vals[0]}' could not be read!")
         file_count.set(len(files_g.paths))
+        if watcher_g:
+            watcher_g.close()
+        watcher_g = regex.FilesWatcher(files_g)
         reset()
         dialog.destroy()
     
@@ -128,15 +137,44 @@ def open_file():
     f2.rowconfigure(0, weight=1)
 
 def save():
+    global journal_g
     if not replacer_g or not files_g:
         return
     replacer_g.apply_sub([x[1] for x in unselected_files if not x[0].get()])
+    journal_g = replacer_g.journal
     reset()
     res = files_g.save()
     # TODO: log file paths somewhere
     if res:
         messagebox.showerror(title="Error", message=f"Some files ({len(res)}) could not be saved!")
 
+def undo_save():
+    global journal_g
+    if not journal_g or not files_g:
+        return
+    # Files are reverted on disk, where they might have been changed since
+    # the save, and then reloaded by the watcher
+    res = journal_g.revert_files()
+    journal_g = None
+    reset()
+    if watcher_g:
+        watcher_g.poll()
+    # TODO: log file paths somewhere
+    if res:
+        messagebox.showerror(title="Error", message=f"Some files ({len(res)}) could not be restored!")
+
+def export_diff():
+    if not replacer_g or not replacer_g.match_info:
+        return
+    path = filedialog.asksaveasfilename(defaultextension=".diff")
+    if not path:
+        return
+    try:
+        with open(path, "w") as f:
+            f.writelines(replacer_g.iter_diff([x[1] for x in unselected_files if not x[0].get()]))
+    except OSError:
+        messagebox.showerror(title="Error", message="The diff could not be saved!")
+
 def find(create=True):
     if not files_g:
         return
@@ -180,6 +218,17 @@ def reset():
     replacer_out_t.configure(state=DISABLED)
     replace_e.delete(0, END)
 
+def _poll_files():
+    # Files changed on disk are reloaded and the find results updated, while
+    # replacement results would be outdated
+    if watcher_g:
+        watcher_g.finder = finder_g
+        if watcher_g.poll() and finder_g:
+            global replacer_g
+            replacer_g = None
+            find(False)
+    root.after(2000, _poll_files)
+
 def _print_info(info, text_w, bg_color, fg_color, add_chbs=False):
     text_w.configure(state=NORMAL)
     text_w.delete("1.0", END)
@@ -268,10 +317,12 @@ file_m.add_command(label="New finder", command=lambda: reset())
 file_m.add_separator()
 file_m.add_command(label="Open...", command=lambda: open_file())
 file_m.add_command(label="Save", command=lambda: save())
+file_m.add_command(label="Export diff...", command=lambda: export_diff())
 
 menubar.add_cascade(menu=edit_m, label="Edit")
 edit_m.add_command(label="Find", command=lambda: find())
 edit_m.add_command(label="Replace", command=lambda: replace())
+edit_m.add_command(label="Undo last save", command=lambda: undo_save())
 
 menubar.add_cascade(menu=options_m, label="Options")
 options_m.add_checkbutton(label="Ignore case", variable=ignore_case_chb_var, onvalue=True, offvalue=False)
@@ -373,4 +424,5 @@ info_l_num.grid(column=11, row=0, sticky="e")
 options_f.columnconfigure(10, weight=1)
 
 
+root.after(2000, _poll_files)
 root.mainloop()
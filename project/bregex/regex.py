@@ -6,10 +6,46 @@ are mutually related, so a Files and an Options object are passed to a Finder
 object, which in turn is passed to a Replacer object. Such a structure means
 that after passing an instantiated object, its state shouldn’t be manipulated
 anymore to prevent undesirable results.
+Find and replacement results are stored in MatchTable objects. Compiled
+patterns are shared by all objects through the module-level PatternCache
+object “pattern_cache”. Repeated searches in large sets of files can be
+sped up by a TrigramIndex object passed to a Finder object, and reopening
+them by a FileCache object passed to a Files object. A FilesWatcher object
+keeps a Files object and the results of a Finder object up to date with
+changes made to the files on disk. Changes applied by a Replacer object are
+recorded in an UndoJournal object, which can revert them.
 """
 
+import bisect
+import bz2
+import codecs
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import gzip
+import io
+import itertools
+import locale
+import lzma
+import mmap
 import os
 import re
+import shutil
+import sqlite3
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections.abc import Mapping
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
 
 
 FILEPATH = 0
@@ -18,6 +54,28 @@ IF = 2
 IFNOT = 3
 NULL = 4
 BINARY = 5
+IFANY = 6
+
+_EOL_PATTERN = re.compile("[\r\n]")
+_BYTES_EOL_PATTERN = re.compile(b"[\r\n]")
+# Encoded chars the str splitlines() method splits on besides the ones
+# translated to "\n" by the universal newlines mode
+_BYTES_RARE_EOLS = tuple(x.encode() for x in "\v\f\x1c\x1d\x1e\x85\u2028\u2029")
+_BYTES_EOLS = (b"\n", b"\r") + _BYTES_RARE_EOLS
+_NON_RARE_EOL_BYTES = bytes(x for x in range(0x100)
+                            if x not in b"\v\f\x1c\x1d\x1e\x85\xa8\xa9")
+_NON_CONTINUATION_BYTES = bytes(range(0x80)) + bytes(range(0xc0, 0x100))
+# Chars the str splitlines() method splits on
+_EOL_CHARS = "\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029"
+_REPEAT_OPS = tuple(getattr(sre_constants, x) for x in
+                    ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+                    if hasattr(sre_constants, x))
+_GROUPREF_OPS = (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS)
+# Files with these extensions are decompressed when searched as streams
+_STREAM_OPENERS = {".gz": gzip.open,
+                   ".bz2": bz2.open,
+                   ".xz": lzma.open,
+                   ".lzma": lzma.open}
 
 
 class Options():
@@ -31,13 +89,23 @@ class Options():
                  ignore_case=False,
                  multiline=False,
                  dot_all=False,
-                 ignore_diacritics=False):
+                 ignore_diacritics=False,
+                 mmap_min_size=None,
+                 chunk_size=None,
+                 chunk_overlap=4096):
         self.data_type = data_type
         self.ignore_case = ignore_case
         self.multiline = multiline
         self.dot_all = dot_all
         # TODO
         self.ignore_diacritics = ignore_diacritics
+        # Files of at least this size in bytes are searched directly on disk
+        # (see Finder)
+        self.mmap_min_size = mmap_min_size
+        # Unmodified files are read and searched in chunks of this size in
+        # chars, overlapping by at least chunk_overlap chars (see Finder)
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
 
     def get_flags(self):
         """
@@ -54,34 +122,105 @@ class Options():
         return flags
 
 
+class PatternCache:
+    """
+    A least recently used cache of compiled patterns keyed by a pattern and
+    its flags. Unlike the internal cache of the re module, its size is
+    configurable via self.max_size and its efficiency can be checked via the
+    self.hits and self.misses counters.
+    """
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._patterns = collections.OrderedDict()
+
+    def get(self, pattern, flags=0):
+        """
+        Return “pattern” compiled with “flags”, compiling it only if it is
+        not cached yet. An invalid pattern raises re.error and isn’t cached.
+        """
+        key = (pattern, flags)
+        compiled = self._patterns.get(key)
+        if compiled is not None:
+            self._patterns.move_to_end(key)
+            self.hits += 1
+            return compiled
+        self.misses += 1
+        compiled = re.compile(pattern, flags)
+        self._patterns[key] = compiled
+        while len(self._patterns) > max(self.max_size, 0):
+            self._patterns.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        """
+        Remove all cached patterns and reset the counters.
+        """
+        self._patterns.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+pattern_cache = PatternCache()
+
+
 class Files:
     """
     A class for open, store and write operations on files. It is not
     responsible for any changes made to data.
     Current state of the object is accessible via public attributes self.paths
     and self.contents.
+    If “lazy” is True, self.contents doesn’t hold the contents of all files.
+    Instead, a file is read on first access and kept in a least recently used
+    cache limited to “max_bytes” of memory. Modified contents are kept until
+    they are saved by the save() method.
+    If “cache”, a FileCache object, is given, unchanged files are taken from
+    it instead of being read, and files read are added to it.
     """
 
-    def __init__(self):
+    # The number of bytes checked to recognize a binary file before reading
+    # it as a whole
+    _SNIFF_SIZE = 8192
+
+    def __init__(self, lazy=False, max_bytes=256 * 1024 * 1024, cache=None):
         self.paths = []
-        self.contents = []
+        self.cache = cache
+        if lazy:
+            self.contents = _LazyContents(self, max_bytes)
+        else:
+            self.contents = []
         
         self._path_changes_i = []
         self._content_changes_i = []
+        # Statistics of the last save() call
+        self.saved_bytes = 0
+        self.save_seconds = 0.0
+        # idx: fingerprint of files written by save(), which FilesWatcher
+        # objects don’t reload
+        self._saved_fingerprints = {}
+        # Line-end offsets of data elements, built on demand by
+        # _get_line_ends()
+        self._line_ends = {}
 
-    def set(self, path, recursively):
+    def set(self, path, recursively, workers=1):
         """
         Open “path” that can lead to either a file or a directory. If the path
         is a directory, a recursive search can be applied using the
         “recursively” argument. After getting all the paths and saving them to
         self.paths, the contents of the read files are saved to self.contents.
+        With more than one of “workers”, files are read concurrently by a
+        thread pool of the size, which helps mostly on network filesystems
+        and cold caches.
         Files should be text based, otherwise the BINARY constant is appended
         to self.contents.
         The method returns a tuple with a boolean informing about the validity
-        of the passed path and a list of files that couldn’t be read due to an
-        OSError.
+        of the passed path, a list of files that couldn’t be read due to an
+        OSError and a list of files recognized as binary. In the lazy mode,
+        files are read later, so both lists are always empty.
         """
-        res = [True, []]
+        res = [True, [], []]
         # Needed for the os.path module to not confuse a file with a trailing
         # slash with a dir
         path = re.sub(os.sep + "+$", "", path)
@@ -90,8 +229,10 @@ class Files:
             return res
         paths_prev_len = len(self.paths)
         self._append_path(path, recursively)
-        self.paths.sort()
-        failed_files = self._append_content(paths_prev_len)
+        # Only new paths are sorted to keep self.contents aligned
+        self.paths[paths_prev_len:] = sorted(self.paths[paths_prev_len:])
+        failed_files, res[2] = self._append_content(paths_prev_len, workers)
+        self._commit_cache()
         if failed_files:
             failed_paths = []
             for failed_file in reversed(failed_files):
@@ -113,60 +254,252 @@ class Files:
         for idx in reversed(sorted(idxs)):
             self.paths.pop(idx)
             self.contents.pop(idx)
+        self._line_ends = {}
 
     # TODO: allow to rename files
-    def save(self):
+    def save(self, workers=1):
         """
         Save changes made to self.contents. Only affected files will be
-        overwritten.
+        overwritten. Every file is first written to a temporary file in the
+        same dir, which then replaces it, so a failed write never leaves a
+        truncated file behind. The permissions of the files are kept. Files
+        with more than one hard link are overwritten in place by the
+        temporary file instead, as replacing them would break the links, so
+        they may be left truncated by a failed write.
+        With more than one of “workers”, the temporary files are written
+        concurrently by a thread pool of the size. All of them are synced to
+        disk at once before they replace any file.
         The method returns a list of files that couldn’t be overwritten due to
-        an OSError.
+        an OSError. The number of bytes written and the time taken are set to
+        self.saved_bytes and self.save_seconds. Saved files are no longer
+        considered changed.
         """
+        start = time.perf_counter()
         failed_files = []
+        idxs = []
         for idx in self._content_changes_i:
-            if not os.path.isfile(self.paths[idx]):
+            if os.path.isfile(self.paths[idx]):
+                idxs.append(idx)
+            else:
+                failed_files.append(self.paths[idx])
+        if workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                tmp_files = list(executor.map(self._write_tmp_file, idxs))
+        else:
+            tmp_files = list(map(self._write_tmp_file, idxs))
+        # Syncing file by file would take most of the time
+        unsynced = set(_sync_files([x[0] for x in tmp_files if x]))
+        saved_bytes = 0
+        dir_paths = set()
+        copied_paths = []
+        saved_i = set()
+        for idx, tmp_file in zip(idxs, tmp_files):
+            # Symlinks are kept, the files they point to are replaced
+            path = os.path.realpath(self.paths[idx])
+            if tmp_file is None or tmp_file[0] in unsynced:
+                if tmp_file:
+                    _remove_file(tmp_file[0])
                 failed_files.append(self.paths[idx])
                 continue
-            with open(self.paths[idx], "w") as f:
-                try:
-                    f.write(self.contents[idx])
-                except OSError:
-                    failed_files.append(self.paths[idx])
+            try:
+                os.chmod(tmp_file[0], stat.S_IMODE(tmp_file[2].st_mode))
+                if tmp_file[2].st_nlink > 1:
+                    shutil.copyfile(tmp_file[0], path)
+                    _remove_file(tmp_file[0])
+                    copied_paths.append(path)
+                else:
+                    os.replace(tmp_file[0], path)
+                    dir_paths.add(os.path.dirname(path))
+            except OSError:
+                _remove_file(tmp_file[0])
+                failed_files.append(self.paths[idx])
+                continue
+            saved_bytes += tmp_file[1]
+            saved_i.add(idx)
+            self._saved_fingerprints[idx] = _get_fingerprint(self.paths[idx])
+            if isinstance(self.contents, _LazyContents):
+                self.contents._unpin(idx)
+        # Saved contents match the files on disk again
+        self._content_changes_i = [x for x in self._content_changes_i
+                                   if x not in saved_i]
+        # The renames are made durable by syncing each dir once
+        for dir_path in dir_paths:
+            _sync_dir(dir_path)
+        _sync_files(copied_paths)
+        self.saved_bytes = saved_bytes
+        self.save_seconds = time.perf_counter() - start
+        # Files read lazily since the last commit are cached as well
+        self._commit_cache()
         return failed_files
 
+    def _commit_cache(self):
+        """
+        Write the files added to self.cache, if any, to its database.
+        """
+        if self.cache:
+            self.cache.commit()
+
+    def _write_tmp_file(self, idx):
+        """
+        Write the content with the index “idx” to a temporary file next to
+        the file it belongs to. The file isn’t synced to disk yet.
+        Return a tuple with the path of the temporary file, the number of
+        bytes written and the os.stat() result of the original file or None
+        if it couldn’t be written due to an OSError.
+        """
+        path = os.path.realpath(self.paths[idx])
+        tmp_path = None
+        try:
+            file_stat = os.stat(path)
+            fd, tmp_path = tempfile.mkstemp(prefix="." + os.path.basename(path),
+                                            suffix=".tmp",
+                                            dir=os.path.dirname(path))
+            # The encoding and EOL chars are the same as with open(path, "w")
+            with os.fdopen(fd, "w") as f:
+                f.write(self.contents[idx])
+                f.flush()
+                size = os.fstat(f.fileno()).st_size
+        except (OSError, UnicodeEncodeError):
+            if tmp_path:
+                _remove_file(tmp_path)
+            return None
+        return (tmp_path, size, file_stat)
+
     def _append_path(self, path, recursively):
-        def append_if_possible(path):
-            if path not in self.paths:
-                self.paths.append(path)
+        known_paths = set(self.paths)
+        
+        def append_if_possible(path, file_id=None):
+            if path in known_paths:
+                return
+            # Hard links and symlinks lead to files already found
+            if file_id is not None:
+                if file_id in file_ids:
+                    return
+                file_ids.add(file_id)
+            known_paths.add(path)
+            self.paths.append(path)
         
         if not os.path.isdir(path):
             append_if_possible(path)
             return
         
-        dirs = [path]
+        # (st_dev, st_ino) pairs of visited dirs prevent symlink loops
+        dir_ids = set()
+        file_ids = set()
+        dirs = collections.deque([path])
         while dirs:
-            dir_paths = os.listdir(dirs[0])
-            for dir_path in dir_paths:
-                ext_path = os.path.join(dirs[0], dir_path)
-                if not os.path.isdir(ext_path):
-                    append_if_possible(ext_path)
+            dir_path = dirs.popleft()
+            try:
+                dir_stat = os.stat(dir_path)
+                entries = os.scandir(dir_path)
+            except OSError:
+                continue
+            if (dir_stat.st_dev, dir_stat.st_ino) in dir_ids:
+                entries.close()
+                continue
+            dir_ids.add((dir_stat.st_dev, dir_stat.st_ino))
+            with entries:
+                # Entries that aren’t symlinks come first, then by name, so
+                # the path kept for a file behind hard links or symlinks
+                # doesn’t depend on the order of the filesystem
+                entries = sorted(entries,
+                                 key=lambda x: (x.is_symlink(), x.name))
+            for entry in entries:
+                # DirEntry caches the file type, so there is usually no need
+                # for another system call
+                if entry.is_dir():
+                    dirs.append(entry.path)
                 else:
-                    dirs.append(ext_path)
+                    append_if_possible(entry.path,
+                                       self._get_file_id(entry, dir_stat))
             if not recursively:
                 return
-            dirs.pop(0)
 
-    def _append_content(self, start_idx):
+    def _get_file_id(self, entry, dir_stat):
+        """
+        Get a (st_dev, st_ino) pair identifying the file behind the DirEntry
+        “entry” found in a dir with the os.stat() result “dir_stat”. Only
+        symlinks need a system call. The method returns None if the file
+        can’t be identified, e.g. due to a broken symlink.
+        """
+        try:
+            if entry.is_symlink():
+                entry_stat = entry.stat()
+                return (entry_stat.st_dev, entry_stat.st_ino)
+            return (dir_stat.st_dev, entry.inode())
+        except OSError:
+            return None
+
+    def _append_content(self, start_idx, workers=1):
+        paths = self.paths[start_idx:]
+        if isinstance(self.contents, _LazyContents):
+            self.contents._extend(len(paths))
+            return ([], [])
+        if workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                # map() keeps the order of paths
+                contents = list(executor.map(self._read_file, paths))
+        else:
+            contents = map(self._read_file, paths)
         failed_files = []
-        for i, path in enumerate(self.paths[start_idx:]):
-            with open(path, "r") as f:
-                try:
-                    self.contents.append(f.read())
-                except OSError:
-                    failed_files.append((i, path))
-                except UnicodeDecodeError:
-                    self.contents.append(BINARY)
-        return failed_files
+        binary_paths = []
+        for i, (path, content) in enumerate(zip(paths, contents)):
+            if content is None:
+                failed_files.append((start_idx + i, path))
+                continue
+            if content == BINARY:
+                binary_paths.append(path)
+            self.contents.append(content)
+        return (failed_files, binary_paths)
+
+    def _read_file(self, path):
+        """
+        Return the content of the file “path”, the BINARY constant if it isn’t
+        a text file or None if it couldn’t be read due to an OSError. A file
+        is considered binary if its first bytes contain a null byte or can’t
+        be decoded, or if the whole file can’t be decoded.
+        """
+        fingerprint = None
+        if self.cache:
+            # Taken before reading, so a file changed meanwhile isn’t cached
+            # as unchanged
+            fingerprint = _get_fingerprint(path)
+            if fingerprint:
+                content = self.cache.get(path, fingerprint)
+                if content is not None:
+                    return content
+        try:
+            with open(path, "rb") as f:
+                # Most binary files are recognized by their first bytes, so
+                # they aren’t read as a whole
+                head = f.read(self._SNIFF_SIZE)
+                if _is_binary(head):
+                    content = BINARY
+                else:
+                    f.seek(0)
+                    content = io.TextIOWrapper(f).read()
+        except OSError:
+            return None
+        except UnicodeDecodeError:
+            content = BINARY
+        if fingerprint:
+            self.cache.put(path, fingerprint, content)
+        return content
+
+    def _reload(self, idx):
+        """
+        Read the file with the index “idx” again. In the lazy mode, it’s only
+        dropped from the cache to be read on next access. Return False if the
+        file couldn’t be read due to an OSError.
+        """
+        if isinstance(self.contents, _LazyContents):
+            self.contents._uncache(idx)
+            return True
+        content = self._read_file(self.paths[idx])
+        if content is None:
+            return False
+        self.contents[idx] = content
+        return True
 
     def _get_data(self, data_type):
         """
@@ -179,6 +512,37 @@ class Files:
         if data_type == FILECONTENT:
             return self.contents
 
+    def _get_line_ends(self, data_type, idx, string):
+        """
+        A method called from outside the class to get an array of the end
+        offsets of all lines inside “string”, which is the data element with
+        the index “idx” of the “data_type” constant. Lines are split the same
+        way as by the str splitlines() method. The array is built on the
+        first call and reused as long as the data element stays the same
+        object.
+        """
+        cached = self._line_ends.get((data_type, idx))
+        if cached and cached[0] is string:
+            return cached[1]
+        fingerprint = None
+        line_ends = None
+        # Only unmodified contents match the files on disk
+        if (self.cache and
+            data_type == FILECONTENT and
+            idx not in self._content_changes_i):
+            fingerprint = _get_fingerprint(self.paths[idx])
+            if fingerprint:
+                line_ends = self.cache.get_line_ends(self.paths[idx],
+                                                     fingerprint)
+        if line_ends is None:
+            line_ends = _build_line_ends(string)
+            if fingerprint:
+                self.cache.put_line_ends(self.paths[idx],
+                                         fingerprint,
+                                         line_ends)
+        self._line_ends[(data_type, idx)] = (string, line_ends)
+        return line_ends
+
     def _log_change(self, data_type, idx):
         """
         A method called from outside the class to store “idx“ of modified data
@@ -192,6 +556,1540 @@ class Files:
             self._content_changes_i.append(idx)
 
 
+class _LazyContents:
+    """
+    An internal list-like replacement of Files.contents for the lazy mode.
+    Contents are read from the files in Files.paths on first access and kept
+    in a least recently used cache until their total size exceeds
+    “max_bytes”. Assigned contents are pinned, so they are never evicted
+    before they are saved.
+    If a file can’t be read due to an OSError, its content is None.
+    """
+
+    def __init__(self, files, max_bytes):
+        self.max_bytes = max_bytes
+        self._files = files
+        self._len = 0
+        self._cached = collections.OrderedDict()
+        # idx: size of the cached content when it was added, as the size of
+        # a str grows once it’s encoded, e.g. to be sent to a worker process
+        self._cached_sizes = {}
+        self._cached_bytes = 0
+        self._pinned = {}
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[x] for x in range(*idx.indices(self._len))]
+        idx = self._check_idx(idx)
+        if idx in self._pinned:
+            return self._pinned[idx]
+        if idx in self._cached:
+            self._cached.move_to_end(idx)
+            return self._cached[idx]
+        content = self._files._read_file(self._files.paths[idx])
+        self._cache(idx, content)
+        return content
+
+    def __setitem__(self, idx, content):
+        idx = self._check_idx(idx)
+        self._uncache(idx)
+        self._pinned[idx] = content
+
+    def __iter__(self):
+        for idx in range(self._len):
+            yield self[idx]
+
+    def __eq__(self, other):
+        if not isinstance(other, (_LazyContents, list)):
+            return NotImplemented
+        return (len(self) == len(other) and
+                all(x == y for x, y in zip(self, other)))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"_LazyContents(len={self._len}, pinned={len(self._pinned)})"
+
+    def append(self, content):
+        self._len += 1
+        self._pinned[self._len - 1] = content
+
+    def pop(self, idx=-1):
+        idx = self._check_idx(idx)
+        content = self._pinned.get(idx, self._cached.get(idx))
+        self._uncache(idx)
+        self._pinned.pop(idx, None)
+        
+        def shift(d):
+            return {(x - 1 if x > idx else x): y for x, y in d.items()}
+        
+        self._cached = collections.OrderedDict(shift(self._cached))
+        self._cached_sizes = shift(self._cached_sizes)
+        self._pinned = shift(self._pinned)
+        self._len -= 1
+        return content
+
+    def _extend(self, count):
+        """
+        Add “count” contents to be read on first access.
+        """
+        self._len += count
+
+    def _unpin(self, idx):
+        """
+        Move saved content from the pinned ones to the cache.
+        """
+        if idx in self._pinned:
+            self._cache(idx, self._pinned.pop(idx))
+
+    def _check_idx(self, idx):
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError("list index out of range")
+        return idx
+
+    def _cache(self, idx, content):
+        self._cached[idx] = content
+        self._cached_sizes[idx] = sys.getsizeof(content)
+        self._cached_bytes += self._cached_sizes[idx]
+        # The most recent content is kept even if it exceeds the limit alone
+        while self._cached_bytes > self.max_bytes and len(self._cached) > 1:
+            self._uncache(next(iter(self._cached)))
+
+    def _uncache(self, idx):
+        if idx not in self._cached:
+            return
+        del self._cached[idx]
+        self._cached_bytes -= self._cached_sizes.pop(idx)
+        # Line indices are rebuilt together with the content
+        self._files._line_ends.pop((FILECONTENT, idx), None)
+
+
+class TrigramIndex:
+    """
+    An index of the trigrams (three-char substrings) contained in the files
+    of Files objects, which lets a Finder skip files that can’t match a
+    pattern without searching them (see Finder). The index is kept in the
+    SQLite database file “path”, which is created if it doesn’t exist, and
+    queried by searches without being loaded into memory. Without “path”,
+    or if the file isn’t a readable index, an empty index is kept in memory
+    instead.
+    The index is updated by the update() method, which only reads files that
+    are new or changed since they were indexed. Changes are written to the
+    file by the save() method. Files changed after the last update may be
+    missed by a search.
+    """
+
+    # Incremented whenever the format of saved indices changes
+    _VERSION = 2
+
+    def __init__(self, path=None):
+        self.path = path
+        self._connection = None
+        # path: file_id of all indexed files, loaded by _get_file_id()
+        self._file_ids = None
+        if path:
+            try:
+                self._connection = self._connect(path)
+            except sqlite3.Error:
+                pass
+        # Whether the index isn’t stored in self.path
+        self._in_memory = self._connection is None
+        if self._in_memory:
+            self._connection = self._connect(":memory:")
+
+    def __len__(self):
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def update(self, files):
+        """
+        Index the contents of the files of “files”, a Files object, that are
+        new or changed according to their size, modification time and inode.
+        Files with unsaved changes aren’t indexed, and indexed files that
+        don’t exist anymore are dropped. Only the rows of the dropped and
+        changed files are written.
+        """
+        indexed = {path: (file_id, tuple(fingerprint))
+                   for path, file_id, *fingerprint in self._connection.execute(
+                       "SELECT path, file_id, size, mtime_ns, inode "
+                       "FROM files")}
+        stale_ids = {file_id for path, (file_id, _) in indexed.items()
+                     if not os.path.isfile(path)}
+        # path: (idx, fingerprint) of files to be indexed
+        changed = {}
+        for idx, path in enumerate(files.paths):
+            fingerprint = _get_fingerprint(path)
+            entry = indexed.get(path)
+            if entry and entry[1] == fingerprint:
+                continue
+            if entry:
+                stale_ids.add(entry[0])
+            if fingerprint is None or idx in files._content_changes_i:
+                continue
+            changed[path] = (idx, fingerprint)
+        self._file_ids = None
+        self._connection.executemany("DELETE FROM postings WHERE file_id = ?",
+                                     ((x,) for x in stale_ids))
+        self._connection.executemany("DELETE FROM files WHERE file_id = ?",
+                                     ((x,) for x in stale_ids))
+        for path, (idx, fingerprint) in changed.items():
+            file_id = self._connection.execute(
+                "INSERT INTO files (path, size, mtime_ns, inode) "
+                "VALUES (?, ?, ?, ?)",
+                (path, *fingerprint)).lastrowid
+            content = files.contents[idx]
+            # Binary files have no trigrams, as they never match
+            if type(content) is not str:
+                continue
+            self._connection.executemany(
+                "INSERT INTO postings VALUES (?, ?)",
+                ((x, file_id) for x in _get_trigrams(content)))
+
+    def save(self, path=None):
+        """
+        Write the changes of the index to its database file self.path. If
+        “path” is given, or the index is kept in memory, the whole index is
+        copied to the file “path” or self.path instead, which replaces the
+        previous file only when it is completely written. Raise ValueError
+        if neither path is set.
+        """
+        path = path or self.path
+        if not path:
+            raise ValueError("No path to save the index to")
+        self._connection.commit()
+        if path == self.path and not self._in_memory:
+            return
+        tmp_path = path + ".tmp"
+        # A database left behind by a failed write would be reused otherwise
+        _remove_file(tmp_path)
+        connection = sqlite3.connect(tmp_path)
+        try:
+            self._connection.backup(connection)
+        finally:
+            connection.close()
+        os.replace(tmp_path, path)
+
+    def close(self):
+        """
+        Close the database. Changes not written by the save() method are
+        discarded.
+        """
+        self._connection.close()
+
+    def _connect(self, path):
+        """
+        Open the index database file “path” and create its tables if the
+        database is empty. Raise sqlite3.Error if it isn’t an index of the
+        current version.
+        """
+        connection = sqlite3.connect(path)
+        try:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version == 0:
+                if connection.execute(
+                        "SELECT COUNT(*) FROM sqlite_master").fetchone()[0]:
+                    raise sqlite3.DatabaseError("Not a trigram index")
+                connection.executescript(
+                    "CREATE TABLE files ("
+                    "file_id INTEGER PRIMARY KEY, "
+                    "path TEXT UNIQUE, "
+                    "size INTEGER, "
+                    "mtime_ns INTEGER, "
+                    "inode INTEGER);"
+                    "CREATE TABLE postings ("
+                    "trigram TEXT, "
+                    "file_id INTEGER, "
+                    "PRIMARY KEY (trigram, file_id)) WITHOUT ROWID;"
+                    "CREATE INDEX postings_file_id ON postings (file_id);"
+                    f"PRAGMA user_version = {self._VERSION:d};")
+            elif version != self._VERSION:
+                raise sqlite3.DatabaseError("Unsupported index version")
+        except sqlite3.Error:
+            connection.close()
+            raise
+        return connection
+
+    def _get_file_id(self, path):
+        """
+        Get the id of the indexed file “path” or None if it isn’t indexed.
+        """
+        # Searches look up every file, so the ids are loaded all at once
+        if self._file_ids is None:
+            self._file_ids = dict(self._connection.execute(
+                "SELECT path, file_id FROM files"))
+        return self._file_ids.get(path)
+
+    def _get_candidates(self, literals):
+        """
+        Get the set of ids of indexed files containing all trigrams of
+        “literals” or None if the literals have no trigrams.
+        """
+        trigrams = set()
+        for literal in literals:
+            trigrams.update(_get_trigrams(literal))
+        if not trigrams:
+            return None
+        # Rare trigrams first keep the intersection small
+        counts = sorted((self._connection.execute(
+                             "SELECT COUNT(*) FROM postings WHERE trigram = ?",
+                             (x,)).fetchone()[0], x)
+                        for x in trigrams)
+        candidates = None
+        for _, trigram in counts:
+            file_ids = {x[0] for x in self._connection.execute(
+                "SELECT file_id FROM postings WHERE trigram = ?", (trigram,))}
+            candidates = (file_ids if candidates is None else
+                          candidates & file_ids)
+            if not candidates:
+                break
+        return candidates
+
+
+class FileCache:
+    """
+    A persistent cache of file contents stored in the SQLite database file
+    “path”, which is passed to Files objects so that files that haven’t
+    changed since they were cached aren’t read again. A file is considered
+    unchanged as long as its path, size, modification time and inode stay
+    the same. Besides decoded contents, the cache stores whether a file is
+    binary and the line-end offsets built by searches.
+    Cached data are written to the database by the commit() method, which
+    Files objects call after reading files in the set() method, after
+    saving them and after searches, which read files in the lazy mode. The
+    self.hits and self.misses counters show how many files were found in the
+    cache and how many had to be read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        # Files may be read by a thread pool
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS files ("
+                                 "path TEXT PRIMARY KEY, "
+                                 "size INTEGER, "
+                                 "mtime_ns INTEGER, "
+                                 "inode INTEGER, "
+                                 "content TEXT, "
+                                 "line_ends BLOB)")
+
+    def get(self, path, fingerprint):
+        """
+        Get the cached content of the file “path”, or the BINARY constant, if
+        the file hasn’t changed since according to “fingerprint”, a (size,
+        mtime_ns, inode) tuple. Otherwise, return None.
+        """
+        row = self._select("content", path, fingerprint)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return BINARY if row[0] is None else row[0]
+
+    def put(self, path, fingerprint, content):
+        """
+        Cache “content”, the content of the file “path” or the BINARY
+        constant, read when the file had “fingerprint” (see get()).
+        """
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, NULL)",
+                (path,
+                 *fingerprint,
+                 None if content == BINARY else content))
+
+    def get_line_ends(self, path, fingerprint):
+        """
+        Get the cached array of line-end offsets of the file “path” or None
+        if there isn’t any for “fingerprint” (see get()).
+        """
+        row = self._select("line_ends", path, fingerprint)
+        if row is None or row[0] is None:
+            return None
+        line_ends = array("q")
+        line_ends.frombytes(row[0])
+        return line_ends
+
+    def put_line_ends(self, path, fingerprint, line_ends):
+        """
+        Cache “line_ends”, the array of line-end offsets of the file “path”,
+        if its cached content matches “fingerprint” (see get()).
+        """
+        with self._lock:
+            self._connection.execute(
+                "UPDATE files SET line_ends = ? WHERE path = ? AND "
+                "size = ? AND mtime_ns = ? AND inode = ?",
+                (line_ends.tobytes(), path, *fingerprint))
+
+    def commit(self):
+        """
+        Write the cached data to the database.
+        """
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        """
+        Commit the cached data and close the database.
+        """
+        self.commit()
+        self._connection.close()
+
+    def _select(self, column, path, fingerprint):
+        with self._lock:
+            return self._connection.execute(
+                f"SELECT {column} FROM files WHERE path = ? AND "
+                "size = ? AND mtime_ns = ? AND inode = ?",
+                (path, *fingerprint)).fetchone()
+
+
+class FilesWatcher:
+    """
+    A class keeping the contents of a “files” object up to date with changes
+    made to the files on disk. Changes are picked up by calling the poll()
+    method, e.g. periodically from an event loop. On Linux, the dirs of the
+    files are monitored by inotify, so only files reported as changed are
+    checked. Otherwise, or if “use_inotify” is False, all files are checked
+    by comparing their size, modification time and inode.
+    If a “finder” object is set, its last search is repeated in the changed
+    files and the results in its match_info are updated in place.
+    Files with unsaved changes are left as they are, and files created in or
+    deleted from the dirs are ignored, as they would shift the indices of
+    the files.
+    """
+
+    def __init__(self, files, finder=None, use_inotify=True):
+        self.files = files
+        self.finder = finder
+        self._fingerprints = [_get_fingerprint(x) for x in files.paths]
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify({os.path.dirname(x)
+                                          for x in files.paths})
+            except (OSError, AttributeError):
+                pass
+        # (dir, name): idx
+        self._idxs = {os.path.split(x): idx
+                      for idx, x in enumerate(files.paths)}
+
+    def poll(self):
+        """
+        Reload the files changed since the last call and update the results
+        of self.finder.
+        Return a list of indices of the reloaded files.
+        """
+        changed = None
+        if self._inotify:
+            changed = self._inotify.read()
+        if changed is None:
+            idxs = range(len(self.files.paths))
+        else:
+            idxs = sorted({self._idxs[x] for x in changed if x in self._idxs})
+        reloaded = []
+        for idx in idxs:
+            fingerprint = _get_fingerprint(self.files.paths[idx])
+            if fingerprint == self._fingerprints[idx]:
+                continue
+            self._fingerprints[idx] = fingerprint
+            # Files written by Files.save() already hold the contents
+            if fingerprint == self.files._saved_fingerprints.pop(idx, None):
+                continue
+            if (fingerprint is not None and
+                idx not in self.files._content_changes_i and
+                self.files._reload(idx)):
+                reloaded.append(idx)
+        if reloaded and self.finder and self.finder.pattern:
+            self.finder._refresh(reloaded)
+        if reloaded:
+            self.files._commit_cache()
+        return reloaded
+
+    def close(self):
+        """
+        Stop monitoring the dirs.
+        """
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+
+
+class _Inotify:
+    """
+    A minimal wrapper of the Linux inotify API, which reports changes of
+    files inside the dirs “dirs”.
+    """
+
+    # IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO,
+    # IN_CREATE and IN_DELETE
+    _MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    _IN_Q_OVERFLOW = 0x4000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, dirs):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # wd: dir
+        self._dirs = {}
+        for dir_ in dirs:
+            wd = libc.inotify_add_watch(self._fd,
+                                        os.fsencode(dir_ or os.curdir),
+                                        self._MASK)
+            if wd < 0:
+                self.close()
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self._dirs[wd] = dir_
+
+    def read(self):
+        """
+        Return a set of (dir, name) pairs of the files changed since the last
+        call or None if some changes were lost.
+        """
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 1 << 16)
+            except BlockingIOError:
+                return changed
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = self._EVENT.unpack_from(buf, pos)
+                pos += self._EVENT.size
+                name = buf[pos:pos + length].rstrip(b"\0")
+                pos += length
+                if mask & self._IN_Q_OVERFLOW:
+                    # Drains the queue
+                    self.read()
+                    return None
+                if wd in self._dirs:
+                    changed.add((self._dirs[wd], os.fsdecode(name)))
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _remove_file(path):
+    """
+    Remove the file “path”, ignoring an OSError.
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _sync_files(paths):
+    """
+    Sync the files “paths” to disk and return a list of those that couldn’t
+    be synced due to an OSError. On Linux, every filesystem holding the
+    files is synced once by syncfs() instead of syncing each file.
+    """
+    try:
+        syncfs = ctypes.CDLL(ctypes.util.find_library("c"),
+                             use_errno=True).syncfs
+    except (OSError, TypeError, AttributeError):
+        syncfs = None
+    failed_paths = []
+    # st_dev: whether the filesystem was synced
+    synced = {}
+    for path in paths:
+        try:
+            if syncfs is None:
+                _sync_path(path, os.fsync)
+                continue
+            dev = os.stat(path).st_dev
+            if dev not in synced:
+                try:
+                    _sync_path(path, syncfs)
+                    synced[dev] = True
+                except OSError:
+                    synced[dev] = False
+            if not synced[dev]:
+                failed_paths.append(path)
+        except OSError:
+            failed_paths.append(path)
+    return failed_paths
+
+
+def _sync_path(path, sync):
+    """
+    Call “sync”, os.fsync() or syncfs(), with a file descriptor of the file
+    “path”.
+    """
+    fd = os.open(path, os.O_RDWR)
+    try:
+        if sync(fd) not in (None, 0):
+            raise OSError(ctypes.get_errno(), "syncfs failed")
+    finally:
+        os.close(fd)
+
+
+def _sync_dir(path):
+    """
+    Sync the entries of the dir “path” to disk, where dirs can be opened,
+    ignoring an OSError.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _read_database(path, version, queries):
+    """
+    Run the SELECT statements “queries” in the SQLite database file “path”
+    written by _write_database() and return a list with the rows of each.
+    Return None if the file doesn’t exist, wasn’t written with “version” or
+    can’t be read as a database.
+    """
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        connection = sqlite3.connect(path)
+    except sqlite3.Error:
+        return None
+    try:
+        if connection.execute("PRAGMA user_version").fetchone()[0] != version:
+            return None
+        return [connection.execute(x).fetchall() for x in queries]
+    except sqlite3.Error:
+        return None
+    finally:
+        connection.close()
+
+
+def _write_database(path, version, tables):
+    """
+    Write “tables”, (name, columns, rows) tuples, to a new SQLite database
+    file marked with “version”, which replaces the file “path” only when it
+    is completely written.
+    """
+    tmp_path = path + ".tmp"
+    # A database left behind by a failed write would be reused otherwise
+    _remove_file(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.execute(f"PRAGMA user_version = {version:d}")
+        for name, columns, rows in tables:
+            connection.execute(f"CREATE TABLE {name} ({columns})")
+            params = ", ".join("?" * (columns.count(",") + 1))
+            connection.executemany(f"INSERT INTO {name} VALUES ({params})",
+                                   rows)
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+
+
+def _get_fingerprint(path):
+    """
+    Get a (size, mtime_ns, inode) tuple of the file “path” telling whether
+    it has changed or None if it can’t be accessed.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def _get_trigrams(string):
+    """
+    Get the set of all three-char substrings of “string” not crossing a line
+    break. Repeated lines are processed only once.
+    """
+    trigrams = set()
+    for line in set(string.splitlines()):
+        trigrams.update(line[i:i + 3] for i in range(len(line) - 2))
+    return trigrams
+
+
+def _is_binary(head):
+    """
+    Return True if “head”, the first bytes of a file, contain a null byte or
+    can’t be decoded using the encoding files are read with. A multibyte char
+    cut off at the end of “head” is ignored.
+    """
+    if b"\0" in head:
+        return True
+    decoder = codecs.getincrementaldecoder(
+        locale.getpreferredencoding(False))()
+    try:
+        decoder.decode(head)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+def _build_line_ends(string):
+    """
+    Get an array of the end offsets of all lines inside “string”. Lines are
+    split the same way as by the str splitlines() method.
+    """
+    return array("q", itertools.accumulate(
+        len(line) for line in string.splitlines(True)))
+
+
+def _compute_line_span(start_idx, match, line_ends):
+    """
+    Get a number of the line where the char index “start_idx” is located
+    using “line_ends”, the line end offsets of the searched string (see
+    _build_line_ends()). “match” is used to count the line span in case it
+    contains an EOL char. The returned line span is a tuple with the starting
+    line included and the ending line excluded.
+    """
+    counter = min(bisect.bisect_right(line_ends, start_idx) + 1,
+                  len(line_ends))
+    return _get_match_line_span(counter, match)
+
+
+def _count_line_number(string, start_idx, counted, eols):
+    """
+    Get a number of the line where the char index “start_idx” of “string”
+    is located the same way as _compute_line_span(), but by counting EOLs
+    instead of building the line end offsets of the whole string. “eols”
+    EOLs were already counted before the index “counted”, which is at most
+    “start_idx”. Return a tuple with the line number and the values of
+    “counted” and “eols” to continue counting with.
+    """
+    line_start = start_idx
+    # The LF of a CRLF belongs to the line of the CR
+    if start_idx > 0 and string[start_idx - 1:start_idx + 1] == "\r\n":
+        line_start -= 1
+    eols += _count_eols(string, counted, line_start)
+    counter = eols + 1
+    # There is no line after an EOL ending the string
+    if line_start == len(string) and (not string or
+                                      string[-1] in _EOL_CHARS):
+        counter = eols
+    return counter, line_start, eols
+
+
+def _get_match_line_span(counter, match):
+    """
+    Get the line span of “match” starting at the line number “counter”.
+    """
+    match_counter = len(match.splitlines(True))
+    if match_counter > 1:
+        end_idx = counter + match_counter
+        return (counter, end_idx)
+    else:
+        return (counter, counter + 1)
+
+
+def _find_in_chunk(pattern, flags, logical_op, chunk, limit=None):
+    """
+    Search the (idx, string) pairs of “chunk” in a worker process of a
+    parallel Finder. For the IF constant, return a list of (idx, results)
+    pairs where results are (line_span, match_span) tuples of every match.
+    For the IFNOT constant, results are a boolean telling whether the string
+    matches at all. “limit” is the maximum number of matches of a string.
+    """
+    compiled = pattern_cache.get(pattern, flags)
+    res = []
+    for idx, string in chunk:
+        if logical_op == IFNOT:
+            res.append((idx, compiled.search(string) is not None))
+            continue
+        matches = []
+        line_ends = None
+        for match_obj in itertools.islice(compiled.finditer(string), limit):
+            if line_ends is None:
+                line_ends = _build_line_ends(string)
+            matches.append((_compute_line_span(match_obj.start(),
+                                               match_obj.group(0),
+                                               line_ends),
+                            match_obj.span()))
+        res.append((idx, matches))
+    return res
+
+
+def _decode_mapped(data, errors="strict"):
+    """
+    Decode UTF-8 “data” read from a memory-mapped file the way a file opened
+    in text mode is decoded, including the universal newlines translation.
+    """
+    return (data.decode("utf-8", errors).
+            replace("\r\n", "\n").
+            replace("\r", "\n"))
+
+
+def _get_safe_position(buf, start, end):
+    """
+    Move the position “end” inside “buf” back to the nearest position, not
+    before “start”, that doesn’t split an encoded char or a CRLF sequence.
+    """
+    while end > start and end < len(buf) and buf[end] & 0xc0 == 0x80:
+        end -= 1
+    if end > start and buf[end - 1:end + 1] == b"\r\n":
+        end -= 1
+    return end
+
+
+def _count_mapped(buf, start, end):
+    """
+    Count the decoded chars and the line breaks inside “buf” between the
+    positions “start” and “end”, which must not split an encoded char or a
+    CRLF sequence (see _get_safe_position()). Data are processed in bounded
+    chunks, so the cost in memory stays constant.
+    Return a tuple with the number of chars and the number of line breaks.
+    """
+    chars = 0
+    eols = 0
+    while start < end:
+        chunk_end = min(start + (1 << 24), end)
+        if chunk_end < end:
+            chunk_end = _get_safe_position(buf, start, chunk_end)
+        chunk = buf[start:chunk_end]
+        chars += len(chunk)
+        eols += chunk.count(b"\n")
+        # Each check is a single pass over the chunk, while counting
+        # sequences that are missing anyway is skipped
+        if b"\r" in chunk:
+            crlfs = chunk.count(b"\r\n")
+            chars -= crlfs
+            eols += chunk.count(b"\r") - crlfs
+        if chunk.translate(None, _NON_RARE_EOL_BYTES):
+            eols += sum(chunk.count(x) for x in _BYTES_RARE_EOLS)
+        if not chunk.isascii():
+            chars -= len(chunk.translate(None, _NON_CONTINUATION_BYTES))
+        start = chunk_end
+    return (chars, eols)
+
+
+def _find_in_mapped(compiled, buf, limit=None):
+    """
+    Find all matches of the bytes pattern “compiled” inside “buf”, a
+    memory-mapped UTF-8 file. Only the lines containing matches are decoded.
+    Spans and line numbers refer to the file content as read in text mode.
+    At most “limit” matches are found if it isn’t None.
+    Return a list of (line, line_span, match_span, match_span_l) tuples or
+    None if the matching lines can’t be decoded.
+    """
+    res = []
+    pos = 0
+    chars = 0
+    eols = 0
+    for match_obj in itertools.islice(compiled.finditer(buf), limit):
+        start, end = match_obj.span()
+        # A CRLF sequence is a single char in the text, so a match boundary
+        # inside it is moved to the char boundary
+        if start == end and buf[start - 1:start + 1] == b"\r\n":
+            start -= 1
+            end -= 1
+        else:
+            if start > 0 and buf[start - 1:start + 1] == b"\r\n":
+                start -= 1
+            if end > 0 and buf[end - 1:end + 1] == b"\r\n":
+                end += 1
+        safe_start = _get_safe_position(buf, pos, start)
+        counts = _count_mapped(buf, pos, safe_start)
+        chars += counts[0]
+        eols += counts[1]
+        pos = safe_start
+        
+        line_start = _find_line_start(start, buf, (b"\n", b"\r"))
+        eol = _BYTES_EOL_PATTERN.search(buf, end)
+        line_end = eol.start() if eol else len(buf)
+        try:
+            window = _decode_mapped(buf[line_start:line_end])
+        except UnicodeDecodeError:
+            return None
+        # Partial chars are ignored in case the pattern matches bytes
+        # inside an encoded char
+        a = len(_decode_mapped(buf[line_start:start], "ignore"))
+        b = len(_decode_mapped(buf[line_start:end], "ignore"))
+        match = window[a:b]
+        line, match_span_l = _extract_line((a, b), match, window)
+        
+        start_chars = chars + (a - len(_decode_mapped(buf[line_start:pos],
+                                                      "ignore")))
+        counter = eols + 1
+        if start == len(buf) and buf[-3:].endswith(_BYTES_EOLS):
+            counter = eols
+        res.append((line,
+                    _get_match_line_span(counter, match),
+                    (start_chars, start_chars + b - a),
+                    match_span_l))
+    return res
+
+
+def _get_required_literals(compiled):
+    """
+    Get the literal substrings that every match of the compiled pattern
+    “compiled” contains, longest first. Patterns ignoring case have none.
+    """
+    if compiled.flags & re.IGNORECASE:
+        return []
+    literals = []
+    _collect_literals(sre_parse.parse(compiled.pattern, compiled.flags),
+                      literals)
+    return sorted(dict.fromkeys(literals), key=len, reverse=True)
+
+
+def _collect_literals(items, literals):
+    """
+    Append runs of literal chars that are required in the parsed pattern
+    “items” to the list “literals”. Optional parts and alternatives are
+    skipped.
+    """
+    run = []
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            literals.append("".join(run))
+            run = []
+        if op is sre_constants.SUBPATTERN:
+            if not av[1] & re.IGNORECASE:
+                _collect_literals(av[3], literals)
+        elif op is getattr(sre_constants, "ATOMIC_GROUP", None):
+            _collect_literals(av, literals)
+        elif op in _REPEAT_OPS and av[0] > 0:
+            _collect_literals(av[2], literals)
+    if run:
+        literals.append("".join(run))
+
+
+def _has_literals(data, literals):
+    """
+    Return True if “data”, a string or a bytes-like object, contains all
+    “literals” (see _get_required_literals()).
+    """
+    for literal in literals:
+        if type(data) is not str:
+            literal = literal.encode()
+        if data.find(literal) == -1:
+            return False
+    return True
+
+
+def _combine_patterns(compiled, flags):
+    """
+    Combine the list of compiled patterns “compiled” into a single pattern
+    that matches wherever any of them does, compiled with “flags”. Return
+    None if they can’t be combined without changing their meaning, i.e. if
+    some of them refer to groups, which would be renumbered, or set global
+    flags inline.
+    """
+    plain_flags = pattern_cache.get("", flags).flags
+    for x in compiled:
+        if x.flags != plain_flags or _has_group_refs(x):
+            return None
+    try:
+        return pattern_cache.get("|".join(f"(?:{x.pattern})"
+                                          for x in compiled),
+                                 flags)
+    except re.error:
+        return None
+
+
+def _has_group_refs(compiled):
+    """
+    Return True if the compiled pattern “compiled” contains a backreference
+    or a conditional referring to a group.
+    """
+    stack = [sre_parse.parse(compiled.pattern, compiled.flags)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, sre_parse.SubPattern):
+            for op, av in item:
+                if op in _GROUPREF_OPS:
+                    return True
+                stack.append(av)
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return False
+
+
+def _get_max_width(compiled):
+    """
+    Get the maximum length of a match of the compiled pattern “compiled” or
+    None if the length is unbounded.
+    """
+    width = sre_parse.parse(compiled.pattern, compiled.flags).getwidth()[1]
+    return width if width < sre_constants.MAXREPEAT - 1 else None
+
+
+def _open_stream(path):
+    """
+    Open the file “path” in text mode the same way Files reads it. Files
+    with an extension from _STREAM_OPENERS are decompressed on the fly.
+    Return None instead if the first bytes read show that the file is
+    binary (see _is_binary()).
+    """
+    opener = _STREAM_OPENERS.get(os.path.splitext(path)[1].lower(), open)
+    f = opener(path, "rb")
+    try:
+        # Peeking doesn’t consume the bytes, so pipes can be sniffed too
+        if _is_binary(f.peek(Files._SNIFF_SIZE)[:Files._SNIFF_SIZE]):
+            f.close()
+            return None
+    except BaseException:
+        f.close()
+        raise
+    return io.TextIOWrapper(f)
+
+
+def _count_eols(string, start, end):
+    """
+    Count the line breaks inside “string” between the indices “start” and
+    “end” the way the str splitlines() method splits lines.
+    """
+    return (sum(string.count(x, start, end) for x in _EOL_CHARS) -
+            string.count("\r\n", start, end))
+
+
+def _iter_stream_matches(compiled, stream, chunk_size, overlap):
+    """
+    Find all matches of the compiled pattern “compiled” inside the text
+    stream “stream”, which is read in chunks of “chunk_size” chars. A match
+    is accepted only if at least “overlap” chars following its start were
+    read, so the results are the same as if the whole text was searched as
+    long as no match, including its lookarounds, spans more chars. Apart
+    from the chunk and the overlap, only the lines containing matches are
+    kept in memory.
+    Yield (line, line_span, match_span, match_span_l) tuples.
+    """
+    buf = ""
+    # The char index of buf[0] inside the whole text
+    base = 0
+    # The search continues from this index, as all earlier matches are known
+    resume = 0
+    empty_at = -1
+    # The number of line breaks before the index “counted”
+    counted = 0
+    eols = 0
+    # Matches waiting for the rest of their line
+    pending = collections.deque()
+    eol_checked = 0
+    eof = False
+    while not eof:
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+        buf_end = base + len(buf)
+        limit = buf_end if eof else buf_end - overlap
+        last_end = resume
+        for match_obj in compiled.finditer(buf, resume - base):
+            start = base + match_obj.start()
+            end = base + match_obj.end()
+            # The match might turn out differently once more data are read
+            if not eof and (start >= limit or end >= buf_end - 1):
+                stop = min(start, limit)
+                break
+            # An empty match found again after resuming the search
+            if start == end == empty_at:
+                continue
+            line_start = start - base
+            if line_start > 0 and buf[line_start - 1:line_start + 1] == "\r\n":
+                line_start -= 1
+            eols += _count_eols(buf, counted - base, line_start)
+            counted = base + line_start
+            pending.append((start, end, eols + 1))
+            last_end = end
+            empty_at = end if start == end else -1
+        else:
+            stop = limit
+        resume = max(last_end, stop)
+
+        while pending:
+            start, end, counter = pending[0]
+            postfix_start = end
+            if end > base and buf[end - base - 1] in "\r\n":
+                postfix_start -= 1
+            if not eof and not _EOL_PATTERN.search(
+                    buf, max(postfix_start, eol_checked) - base):
+                eol_checked = buf_end
+                break
+            pending.popleft()
+            span = (start - base, end - base)
+            match = buf[span[0]:span[1]]
+            line, match_span_l = _extract_line(span, match, buf)
+            # The position after a trailing line break isn’t another line
+            if start == buf_end and eof:
+                counter -= 1 if not buf or buf[-1] in _EOL_CHARS else 0
+            yield (line,
+                   _get_match_line_span(counter, match),
+                   (start, end),
+                   match_span_l)
+        if eof:
+            break
+
+        # Keep the overlap and the line of the next match to be reported,
+        # preceded by a line break if there is any
+        anchor = pending[0][0] if pending else resume
+        keep = min(resume - overlap,
+                   base + _find_line_start(anchor - base, buf))
+        keep = max(keep - 1 - base, 0)
+        if keep > 0 and buf[keep - 1:keep + 1] == "\r\n":
+            keep -= 1
+        if base + keep > counted:
+            eols += _count_eols(buf, counted - base, keep)
+            counted = base + keep
+        buf = buf[keep:]
+        base += keep
+
+
+def _extract_line(span, match, string):
+    """
+    Extract a line from “string” where the span indices “span” are located
+    and insert “match” instead of the substring defined by the span. The
+    “match” argument is necessary to get the correct replacement result,
+    because in these cases the match string differs from the substring
+    defined by the span. The returned line will not contain any EOL chars
+    except those found in the match.
+    Return a tuple with the line and the span of the match inside the line.
+    """
+    line_start = _find_line_start(span[0], string)
+    postfix_start = span[1]
+    if postfix_start > 0 and string[postfix_start - 1] in "\r\n":
+        postfix_start -= 1
+    eol = _EOL_PATTERN.search(string, postfix_start)
+    line_end = eol.start() if eol else len(string)
+    line = str(string[line_start:span[0]] +
+               match +
+               string[postfix_start:line_end])
+    return (line, (span[0] - line_start, span[1] - line_start))
+
+
+def _extract_replaced_line(span, repl, string):
+    """
+    Extract a line the same way as _extract_line() would from a copy of
+    “string” in which the substring defined by the span indices “span” is
+    replaced by “repl”, without making the copy. If “repl” ends with an EOL
+    char, the line ends there.
+    Return a tuple with the line and the span of “repl” inside the line.
+    """
+    line_start = _find_line_start(span[0], string)
+    line = string[line_start:span[0]] + repl
+    if line[-1:] in ("\r", "\n") or (not line and span[0] > 0):
+        postfix = ""
+    else:
+        eol = _EOL_PATTERN.search(string, span[1])
+        postfix = string[span[1]:eol.start() if eol else len(string)]
+    return (line + postfix,
+            (span[0] - line_start, span[0] - line_start + len(repl)))
+
+
+def _iter_spanned_matches(compiled, string, spans):
+    """
+    Yield (span, match object) tuples for the sorted span indices “spans” of
+    matches of “compiled” found inside “string”, using a single finditer()
+    pass that stops after the last span. A span the pass doesn’t yield,
+    e.g. one found by matching raw bytes, is matched again at its start,
+    and if that fails too, None is yielded instead of a match object.
+    """
+    match_objs = compiled.finditer(string)
+    match_obj = next(match_objs, None)
+    for span in spans:
+        while match_obj is not None and match_obj.span() < span:
+            match_obj = next(match_objs, None)
+        if match_obj is not None and match_obj.span() == span:
+            yield (span, match_obj)
+            continue
+        retry = compiled.match(string, span[0])
+        if retry is not None and retry.span() == span:
+            yield (span, retry)
+        else:
+            yield (span, None)
+
+
+def _iter_unified_diff(path, string, changes, context):
+    """
+    Yield the lines of a unified diff between “string”, the content of the
+    file “path”, and the string made by applying “changes”, sorted (start,
+    end, repl) tuples each replacing the substring defined by the span
+    indices with “repl”. Hunks show up to “context” unchanged lines around
+    the changes. Lines are split on "\n" only, as patch tools do, and only
+    the lines around the changes are copied.
+    """
+    header = [f"--- {path}\n", f"+++ {path}\n"]
+    hunk = []
+    # The offset where the last change of the hunk ends and the line
+    # numbers where the hunk starts and, in the old string, ends
+    hunk_end = 0
+    old_start = 0
+    old_end = 0
+    new_start = 0
+    # Lines are counted from “off”, the start of the line “line_num”
+    off = 0
+    line_num = 0
+    # The number of lines added by the previous changes
+    delta = 0
+    for start, end, new in _iter_line_edits(string, changes):
+        old = string[start:end]
+        if old == new:
+            continue
+        line_num += string.count("\n", off, start)
+        off = start
+        old_lines = _split_lines(old)
+        new_lines = _split_lines(new)
+        if hunk and line_num - old_end <= 2 * context:
+            gap = _split_lines(string[hunk_end:start])
+            hunk.extend(" " + x for x in gap)
+        else:
+            if hunk:
+                yield from header
+                header = []
+                yield from _format_hunk(string, hunk, hunk_end, old_start,
+                                        new_start, context)
+            prefix_start = start
+            for _ in range(context):
+                if prefix_start == 0:
+                    break
+                prefix_start = string.rfind("\n", 0, prefix_start - 1) + 1
+            prefix = _split_lines(string[prefix_start:start])
+            hunk = [" " + x for x in prefix]
+            old_start = line_num - len(prefix)
+            new_start = old_start + delta
+        hunk.extend("-" + x for x in old_lines)
+        hunk.extend("+" + x for x in new_lines)
+        hunk_end = end
+        old_end = line_num + len(old_lines)
+        delta += len(new_lines) - len(old_lines)
+    if hunk:
+        yield from header
+        yield from _format_hunk(string, hunk, hunk_end, old_start, new_start,
+                                context)
+
+
+def _iter_line_edits(string, changes):
+    """
+    Yield (start, end, new) tuples, where “start” and “end” are the offsets
+    of the whole lines of “string” affected by “changes” (see
+    _iter_unified_diff()) and “new” is the text replacing them. Changes
+    sharing a line are joined into one edit, as well as a line whose EOL
+    char is replaced with the line following it.
+    """
+    edit = None
+    for change in changes:
+        line_start = string.rfind("\n", 0, change[0]) + 1
+        if edit:
+            while edit[1] < len(string) and not _ends_with_eol(string, edit):
+                edit[1] = _get_line_end(string, edit[1])
+            if line_start >= edit[1]:
+                yield _get_edit_text(string, edit)
+                edit = None
+        if edit is None:
+            edit = [line_start, line_start, []]
+        edit[2].append(change)
+        edit[1] = max(edit[1],
+                      _get_line_end(string, max(change[0], change[1] - 1)))
+    if edit:
+        while edit[1] < len(string) and not _ends_with_eol(string, edit):
+            edit[1] = _get_line_end(string, edit[1])
+        yield _get_edit_text(string, edit)
+
+
+def _get_edit_text(string, edit):
+    """
+    Get a (start, end, new) tuple of “edit”, a [start, end, changes] list
+    (see _iter_line_edits()).
+    """
+    start, end, changes = edit
+    parts = []
+    prev_end = start
+    for change in changes:
+        parts.append(string[prev_end:change[0]])
+        parts.append(change[2])
+        prev_end = change[1]
+    parts.append(string[prev_end:end])
+    return (start, end, "".join(parts))
+
+
+def _ends_with_eol(string, edit):
+    """
+    Return True if the new text of “edit” (see _iter_line_edits()) ends
+    with an EOL char or is empty. Only its last parts are checked.
+    """
+    start, end, changes = edit
+    pos = end
+    for change in reversed(changes):
+        if change[1] < pos:
+            break
+        if change[2]:
+            return change[2][-1] == "\n"
+        pos = change[0]
+    return pos == start or string[pos - 1] == "\n"
+
+
+def _get_line_end(string, idx):
+    """
+    Get the offset following the "\n" ending the line of “string” where
+    the char index “idx” is located, or the length of “string”.
+    """
+    eol = string.find("\n", idx)
+    return len(string) if eol == -1 else eol + 1
+
+
+def _split_lines(string):
+    """
+    Split “string” into lines ending with "\n", except for the last one.
+    """
+    lines = string.split("\n")
+    last = lines.pop()
+    lines = [x + "\n" for x in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def _format_hunk(string, lines, end, old_start, new_start, context):
+    """
+    Yield a hunk made of “lines” followed by up to “context” lines of
+    “string” from the offset “end”, starting at the line “old_start” of the
+    old and the line “new_start” of the new string.
+    """
+    suffix_end = end
+    for _ in range(context):
+        if suffix_end == len(string):
+            break
+        suffix_end = _get_line_end(string, suffix_end)
+    lines.extend(" " + x for x in _split_lines(string[end:suffix_end]))
+    old_range = _format_range(old_start,
+                              sum(1 for x in lines if x[0] != "+"))
+    new_range = _format_range(new_start,
+                              sum(1 for x in lines if x[0] != "-"))
+    yield f"@@ -{old_range} +{new_range} @@\n"
+    for line in lines:
+        if line.endswith("\n"):
+            yield line
+        else:
+            yield line + "\n\\ No newline at end of file\n"
+
+
+def _format_range(start, length):
+    """
+    Format the range of “length” lines from the line “start” for a hunk
+    header, the same way as the difflib module does.
+    """
+    if length == 1:
+        return str(start + 1)
+    if length == 0:
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+
+def _find_line_start(idx, string, eols=("\n", "\r")):
+    """
+    Get the index of the first char of the line inside “string” where the
+    char index “idx” is located. The string is scanned backwards in doubling
+    windows, so the cost is proportional to the line length rather than to
+    the position inside the string. “eols” are the EOL chars, which have to
+    be bytes if “string” is a bytes-like object.
+    """
+    window = 256
+    end = idx
+    while end > 0:
+        start = max(end - window, 0)
+        eol = max(string.rfind(eols[0], start, end),
+                  string.rfind(eols[1], start, end))
+        if eol != -1:
+            return eol + 1
+        end = start
+        window *= 2
+    return 0
+
+
+class MatchTable:
+    """
+    A compact storage of find or replacement results. Every result is a row
+    spread over typed arrays (one per numeric field), so no per-result dict
+    or tuple objects are kept in memory. A row can be appended with its line
+    left out, in which case the line and the span of the match inside it are
+    extracted from the searched string only when they are first accessed.
+    For compatibility, rows are accessible by index or by iteration as
+    read-only mappings with the keys "idx", "path", "line", "line_span",
+    "match_span" and "match_span_l", and a table compares equal to a list of
+    dicts with the same content.
+    """
+
+    __slots__ = ("_paths",
+                 "_sources",
+                 "_idxs",
+                 "_match_starts",
+                 "_match_ends",
+                 "_line_starts",
+                 "_line_ends",
+                 "_match_starts_l",
+                 "_match_ends_l",
+                 "_lines")
+
+    KEYS = ("idx", "path", "line", "line_span", "match_span", "match_span_l")
+
+    def __init__(self):
+        # File paths and searched strings are stored once per file, not once
+        # per row
+        self._paths = {}
+        self._sources = {}
+        self._idxs = array("q")
+        self._match_starts = array("q")
+        self._match_ends = array("q")
+        self._line_starts = array("q")
+        self._line_ends = array("q")
+        self._match_starts_l = array("q")
+        self._match_ends_l = array("q")
+        # None stands for a line not extracted yet
+        self._lines = []
+
+    def append(self,
+               idx,
+               path,
+               line,
+               line_span,
+               match_span,
+               match_span_l,
+               source=None):
+        """
+        Append a row describing a single result. If “line” is None, the line
+        and “match_span_l” are extracted from the searched string “source” on
+        first access. “source” can also be the contents of a lazy Files
+        object, from which the string is taken on first access instead, so
+        the table doesn’t keep it in memory.
+        """
+        self._paths[idx] = path
+        if line is None:
+            self._sources[idx] = source
+            match_span_l = (-1, -1)
+        self._idxs.append(idx)
+        self._match_starts.append(match_span[0])
+        self._match_ends.append(match_span[1])
+        self._line_starts.append(line_span[0])
+        self._line_ends.append(line_span[1])
+        self._match_starts_l.append(match_span_l[0])
+        self._match_ends_l.append(match_span_l[1])
+        self._lines.append(line)
+
+    def _extend(self, other):
+        """
+        Append all rows of the table “other”.
+        """
+        for name in self.__slots__[2:]:
+            getattr(self, name).extend(getattr(other, name))
+        self._paths.update(other._paths)
+        self._sources.update(other._sources)
+
+    def _replace(self, idx, other):
+        """
+        Replace the rows of the data element “idx” with all rows of the
+        table “other”. The rows keep their position or, if there are none,
+        are inserted before the rows of the next data element.
+        """
+        rows = [row for row, x in enumerate(self._idxs) if x == idx]
+        if rows:
+            start = rows[0]
+            end = rows[-1] + 1
+        else:
+            start = next((row for row, x in enumerate(self._idxs) if x > idx),
+                         len(self))
+            end = start
+        for name in self.__slots__[2:]:
+            getattr(self, name)[start:end] = getattr(other, name)
+        for name in ("_paths", "_sources"):
+            column = getattr(self, name)
+            column.pop(idx, None)
+            if idx in getattr(other, name):
+                column[idx] = getattr(other, name)[idx]
+
+    def _materialize(self, row):
+        source = self._sources[self._idxs[row]]
+        if isinstance(source, _LazyContents):
+            source = source[self._idxs[row]]
+        span = (self._match_starts[row], self._match_ends[row])
+        line, span_l = _extract_line(span, source[span[0]:span[1]], source)
+        self._lines[row] = line
+        self._match_starts_l[row] = span_l[0]
+        self._match_ends_l[row] = span_l[1]
+
+    def _get(self, row, key):
+        if key == "idx":
+            return self._idxs[row]
+        if key == "path":
+            return self._paths[self._idxs[row]]
+        if key == "line":
+            if self._lines[row] is None:
+                self._materialize(row)
+            return self._lines[row]
+        if key == "line_span":
+            return (self._line_starts[row], self._line_ends[row])
+        if key == "match_span":
+            return (self._match_starts[row], self._match_ends[row])
+        if key == "match_span_l":
+            if self._lines[row] is None:
+                self._materialize(row)
+            return (self._match_starts_l[row], self._match_ends_l[row])
+        raise KeyError(key)
+
+    def __len__(self):
+        return len(self._idxs)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [_MatchRecord(self, x)
+                    for x in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("MatchTable index out of range")
+        return _MatchRecord(self, row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield _MatchRecord(self, row)
+
+    def __eq__(self, other):
+        if not isinstance(other, (MatchTable, list)):
+            return NotImplemented
+        return (len(self) == len(other) and
+                all(x == y for x, y in zip(self, other)))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"MatchTable({[dict(x) for x in self]!r})"
+
+
+class _MatchRecord(Mapping):
+    """
+    A read-only view of a single MatchTable row.
+    """
+
+    __slots__ = ("_table", "_row")
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    def __getitem__(self, key):
+        return self._table._get(self._row, key)
+
+    def __iter__(self):
+        return iter(MatchTable.KEYS)
+
+    def __len__(self):
+        return len(MatchTable.KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 class _MatchInfo:
     """
     An internal class that stores search or replacement results in
@@ -200,95 +2098,47 @@ class _MatchInfo:
     """
 
     def __init__(self):
-        self.match_info = []
+        self.match_info = MatchTable()
         self._data_i = []
         self._match_span_l = (-1, -1)
+        # The last match_span logged for every idx
+        self._logged = {}
 
     # TODO: limit chars
     def _get_line(self, span, match, string):
         """
         Extract a line from “string” where the span indices “span” are located
-        and insert “match” instead of the substring defined by the span. The
-        “match” argument is necessary to get the correct replacement result,
-        because in these cases the match string differs from the substring
-        defined by the span. The returned line will not contain any EOL chars
-        except those found in the match.
+        and insert “match” instead of the substring defined by the span (see
+        _extract_line()).
         As a side product, the span of the match inside the returned line is
         set as an internal class property to be used later.
         """
-        def is_new_line(char):
-            if (char == "\n" or
-                char == "\r" or
-                char == "\r\n"):
-                return True
-            return False
-        
-        prefix = ""
-        postfix = ""
-        x_minus = span[0] - 1
-        x_plus = span[1]
-        
-        if x_plus > 0 and is_new_line(string[x_plus - 1]):
-            x_plus -= 1
-        while x_minus >= 0:
-            if is_new_line(string[x_minus]):
-                break
-            prefix = string[x_minus] + prefix
-            x_minus -= 1
-        while x_plus < len(string):
-            if is_new_line(string[x_plus]):
-                break
-            postfix += string[x_plus]
-            x_plus += 1
-        
-        if x_minus == -1:
-            a = 0 + span[0]
-            b = span[1]
-        else:
-            a = span[0] - x_minus - 1
-            b = span[1] - x_minus - 1
-        self._match_span_l = (a, b)
-        
-        return str(prefix + match + postfix)
+        line, self._match_span_l = _extract_line(span, match, string)
+        return line
 
-    def _get_line_span(self, start_idx, match, string):
+    def _get_line_span(self, start_idx, match, line_ends):
         """
-        Get a number of the line inside “string” where the char index
-        “start_idx” is located. “match” is used to count the line span in case
-        it contains an EOL char. The returned line span is a tuple with the
-        starting line included and the ending line excluded.
+        Get a number of the line where the char index “start_idx” is located
+        (see _compute_line_span()).
         """
-        lines = string.splitlines(True)
-        counter = 0
-        line_counter = 0
-        for i, line in enumerate(lines):
-            counter += 1
-            line_counter += len(line)
-            if line_counter > start_idx:
-                break
-        match_lines = match.splitlines(True)
-        match_counter = 0
-        for match_line in match_lines:
-            match_counter += 1
-        if match_counter > 1:
-            end_idx = counter + match_counter
-            return (counter, end_idx)
-        else:
-            return (counter, counter + 1)
+        return _compute_line_span(start_idx, match, line_ends)
 
-    def _log_match(self, idx, info):
+    def _log_match(self, idx, info, source=None):
         if not info:
             return
-        # Prevents multiple logging of a single result
-        for x in self.match_info:
-            if idx == x["idx"] and info[2] == x["match_span"]:
-                return
-        self.match_info.append({"idx": idx,
-                                "path": self.files.paths[idx],
-                                "line": info[0],
-                                "line_span": info[1],
-                                "match_span": info[2],
-                                "match_span_l": info[3]})
+        # Prevents multiple logging of a single result. Results of a data
+        # element are always logged in ascending order of their spans, so
+        # anything not following the last logged span is a duplicate.
+        if idx in self._logged and info[2] <= self._logged[idx]:
+            return
+        self._logged[idx] = info[2]
+        self.match_info.append(idx,
+                               self.files.paths[idx],
+                               info[0],
+                               info[1],
+                               info[2],
+                               info[3],
+                               source)
         self._data_i.append(idx)
 
 
@@ -300,84 +2150,584 @@ class Finder(_MatchInfo):
     the results from the previous Finder object by doing a new searches only
     within the range of already found files. Otherwise, all files are searched
     by this method.
+    “workers” sets the number of processes used to search the data. With more
+    than one worker, data elements are distributed to a process pool, while
+    the results stay the same as with a serial search.
+    If options.mmap_min_size is set and “files” is lazy, unmodified files of
+    at least the size are not read into files.contents, but memory-mapped
+    and searched as UTF-8 bytes using the encoded pattern, and only lines
+    containing matches are decoded. Results refer to the content as read in
+    text mode, but the pattern is matched against raw bytes: character
+    classes, the dot and ignoring case only work as usual for ASCII text,
+    and CR or CRLF line endings aren’t translated to “\n” before matching.
+    If options.chunk_size is set and “files” is lazy, other unmodified files
+    are read in chunks instead, so they can be pipes or files compressed by
+    gzip, bzip2 or xz, and memory use doesn’t depend on the file size.
+    Consecutive chunks are searched with an overlap of options.chunk_overlap
+    chars, which is raised to exceed the maximum match length if the pattern
+    has any, so the results are the same as with the whole content. Files
+    whose first bytes, once decompressed, look binary don’t match. Matches
+    found in compressed files can’t be replaced.
+    Before a data element is searched, it is checked for the literal
+    substrings required by the pattern (unless it ignores case) and skipped
+    if any is missing. The self.prefilter_checks and self.prefilter_skips
+    counters of the last search show how many elements were checked and
+    skipped this way.
+    If “index”, a TrigramIndex object, is given, indexed files that lack
+    some trigram of the required literals aren’t searched at all, which is
+    counted by self.index_skips. Files with unsaved changes and files
+    missing in the index are always searched.
+    “max_matches” and “max_matches_per_file” limit the number of results
+    of a search and of a single data element. Once a limit is reached, the
+    search stops, so finding whether there is any match doesn’t require
+    finding all of them. With “max_matches”, data are always searched
+    serially.
     The current find results are stored in self.match_info.
     """
 
-    def __init__(self, files, options, prev_finder=None):
+    # The upper limit for the size of data, in chars, batched into a single
+    # worker process task
+    _CHUNK_SIZE = 1 << 20
+    # Attributes describing the last search and its results, which are set
+    # by _start()
+    _SEARCH_STATE = ("logical_op",
+                     "pattern",
+                     "match_info",
+                     "_data_i",
+                     "_logged",
+                     "_searched_i",
+                     "_compiled",
+                     "_literals",
+                     "_candidates",
+                     "_overlap",
+                     "_limit")
+
+    def __init__(self,
+                 files,
+                 options,
+                 prev_finder=None,
+                 workers=1,
+                 index=None,
+                 max_matches=None,
+                 max_matches_per_file=None):
         super().__init__()
         self.files = files
         self.options = options
+        self.workers = workers
+        self.index = index
+        self.max_matches = max_matches
+        self.max_matches_per_file = max_matches_per_file
         if not prev_finder or not prev_finder._data_i:
             self._data_i = list(range(0, len(self.files.paths)))
         elif prev_finder:
             self._data_i.extend(prev_finder._data_i)
         self.logical_op = None
         self.pattern = None
+        self._compiled = None
+        self._overlap = None
+        self._literals = []
+        # Data elements checked for the literals required by the pattern and
+        # the ones skipped as they lack some
+        self.prefilter_checks = 0
+        self.prefilter_skips = 0
+        # Files skipped based on self.index
+        self.index_skips = 0
+        self._candidates = None
+        # Indices of the data elements searched by the last search
+        self._searched_i = set()
+        # The maximum number of results of the next data element searched
+        self._limit = None
 
     def find(self, logical_op, pattern):
         """
         If “logical_op” is the IF constant, find files that match “pattern”.
         If it is the IFNOT constant, find every file that doesn’t match the
-        specified pattern. If no match was found, the method returns None. If
-        the pattern is an empty string, it also returns None.
+        specified pattern. If it is the IFANY constant, find files that match
+        the pattern, but only with their first match. If no match was found,
+        the method returns None. If the pattern is an empty string, it also
+        returns None.
         After calling the method repeatedly, a new search operation is done in
         the subset of already found files. For entirely new search, create a
         new Finder object.
         """
         if not pattern:
             return
+        _data_i = self._start(logical_op, pattern)
+        data = self.files._get_data(self.options.data_type)
+        # Stopping at a total number of results requires a serial search
+        if self.workers > 1 and len(_data_i) > 1 and self.max_matches is None:
+            self._find_parallel(logical_op, data, _data_i)
+        else:
+            for match_info in self._iter_match_tables(logical_op,
+                                                      data,
+                                                      _data_i):
+                self.match_info._extend(match_info)
+                self._data_i.extend(match_info._idxs)
+        self.files._commit_cache()
+
+    def iter_matches(self, logical_op, pattern):
+        """
+        Search the same way as the find() method, but yield the results file
+        by file as soon as they are found, so they can be processed before
+        the search is done. The search stops when the generator is closed,
+        e.g. by breaking the loop iterating over it. Results are read-only
+        mappings like the rows of self.match_info, but they aren’t stored
+        there, so memory use doesn’t grow with their number. For the same
+        reason, the object keeps the results of its previous search, and
+        another search with it isn’t limited to the files found. Data are
+        always searched serially.
+        """
+        if not pattern:
+            return
+        state = {x: getattr(self, x, None) for x in self._SEARCH_STATE}
+        try:
+            _data_i = self._start(logical_op, pattern)
+            data = self.files._get_data(self.options.data_type)
+            for match_info in self._iter_match_tables(logical_op,
+                                                      data,
+                                                      _data_i):
+                yield from match_info
+        finally:
+            for name, value in state.items():
+                setattr(self, name, value)
+            self.files._commit_cache()
+
+    def _iter_match_tables(self, logical_op, data, idxs):
+        """
+        Search the data elements with the indices “idxs” one by one and yield
+        a MatchTable with the results of each element that has any.
+        """
+        found = 0
+        for idx in idxs:
+            self._limit = self._get_limit(found)
+            if self._limit == 0 and self.max_matches is not None:
+                return
+            match_info = self._find_element(logical_op, data, idx)
+            found += len(match_info)
+            if match_info:
+                yield match_info
+
+    def _find_element(self, logical_op, data, idx):
+        """
+        Search the data element with the index “idx” and return a MatchTable
+        with its results, which aren’t logged in self.match_info.
+        """
+        match_info = self.match_info
+        data_i = self._data_i
+        self.match_info = MatchTable()
+        self._data_i = []
+        try:
+            self._find_by_op(logical_op, data, idx)
+            return self.match_info
+        finally:
+            self.match_info = match_info
+            self._data_i = data_i
+
+    def find_many(self, logical_op, patterns):
+        """
+        Search for every pattern in “patterns” as the find() method does, but
+        in a single pass over the data, so every data element is loaded only
+        once and its line index is shared by all the patterns. An element is
+        first searched for all the patterns combined into one, so elements
+        matching none of them are searched only once. Files searched
+        directly on disk (see the class description) are still read once per
+        pattern. The search is done in the subset of already found files, but
+        the state of the object isn’t changed.
+        Return a dict mapping every pattern to a MatchTable with its results.
+        Empty patterns have empty results.
+        """
+        finders = {}
+        for pattern in patterns:
+            finder = Finder(self.files,
+                            self.options,
+                            index=self.index,
+                            max_matches=self.max_matches,
+                            max_matches_per_file=self.max_matches_per_file)
+            finder._data_i = list(self._data_i)
+            if pattern:
+                finder._start(logical_op, pattern)
+            finders[pattern] = finder
+        finders_used = [x for x in finders.values() if x.pattern]
+        # Data elements that match none of the patterns are skipped after a
+        # single search for all of them at once
+        screen = _combine_patterns([x._compiled for x in finders_used],
+                                   self.options.get_flags())
+        data = self.files._get_data(self.options.data_type)
+        for idx in dict.fromkeys(self._data_i):
+            # Patterns stop being searched for once they have
+            # self.max_matches results
+            for finder in finders_used:
+                finder._limit = finder._get_limit(len(finder.match_info))
+            finders_left = [x for x in finders_used
+                            if x._limit != 0 or x.max_matches is None]
+            if not finders_left:
+                break
+            if (screen and
+                type(data[idx]) is str and
+                not self._is_mapped(idx) and
+                not self._is_streamed(idx) and
+                screen.search(data[idx]) is None):
+                if logical_op == IFNOT:
+                    for finder in finders_left:
+                        finder._log_match(idx, (NULL,
+                                                (-1, -1),
+                                                (-1, -1),
+                                                (-1, -1)))
+                continue
+            for finder in finders_left:
+                finder._find_by_op(logical_op, data, idx)
+        self.files._commit_cache()
+        return {pattern: finder.match_info
+                for pattern, finder in finders.items()}
+
+    def _start(self, logical_op, pattern):
+        """
+        Reset the results and prepare a new search for “pattern”.
+        Return the indices of data elements to be searched.
+        """
         self.logical_op = logical_op
         self.pattern = pattern
+        self._compiled = pattern_cache.get(pattern, self.options.get_flags())
+        self._literals = _get_required_literals(self._compiled)
+        self.prefilter_checks = 0
+        self.prefilter_skips = 0
+        self.index_skips = 0
+        self._candidates = None
+        if self.index is not None and self.options.data_type == FILECONTENT:
+            self._candidates = self.index._get_candidates(self._literals)
+        if self.options.chunk_size is not None:
+            width = _get_max_width(self._compiled)
+            self._overlap = max(self.options.chunk_overlap,
+                                2 if width is None else width + 1)
         _data_i = list(self._data_i)
-        self.match_info = []
+        self.match_info = MatchTable()
         self._data_i = []
-        for idx in _data_i:
-            data = self.files._get_data(self.options.data_type)
-            self._find_by_op(logical_op, data, idx)
+        self._logged = {}
+        # A previous search lists a file once per match
+        _data_i = list(dict.fromkeys(_data_i))
+        self._searched_i = set(_data_i)
+        self._limit = self._get_limit(0)
+        return _data_i
+
+    def _get_limit(self, found):
+        """
+        Get the maximum number of results of a data element searched after
+        “found” results or None if there is no limit.
+        """
+        limits = [self.max_matches_per_file]
+        if self.logical_op == IFANY:
+            limits.append(1)
+        if self.max_matches is not None:
+            limits.append(self.max_matches - found)
+        limits = [x for x in limits if x is not None]
+        return max(min(limits), 0) if limits else None
+
+    def _refresh(self, idxs):
+        """
+        Repeat the last search in the data elements with the indices “idxs”
+        that were searched by it and replace their results in
+        self.match_info.
+        """
+        data = self.files._get_data(self.options.data_type)
+        # The index doesn’t reflect the changes yet
+        candidates = self._candidates
+        self._candidates = None
+        self._limit = self._get_limit(0)
+        for idx in idxs:
+            if idx not in self._searched_i:
+                continue
+            self._logged.pop(idx, None)
+            self.match_info._replace(idx,
+                                     self._find_element(self.logical_op,
+                                                        data,
+                                                        idx))
+        self._candidates = candidates
+        self._data_i = list(self.match_info._idxs)
+
+    def _find_parallel(self, logical_op, data, idxs):
+        """
+        Search data elements with the indices “idxs” using a process pool and
+        log the results in the order of “idxs”.
+        """
+        if logical_op == IFANY:
+            logical_op = IF
+        results = {}
+        chunks = iter(self._get_chunks(data, idxs))
+        futures = set()
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as executor:
+            while True:
+                # Strings are taken only for the chunks being searched, so
+                # lazy contents don’t have to fit in memory all at once
+                while len(futures) < self.workers * 2:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    strings = [(idx, data[idx]) for idx in chunk]
+                    strings = [x for x in strings
+                               if type(x[1]) is str and
+                               _has_literals(x[1], self._literals)]
+                    if strings:
+                        futures.add(executor.submit(_find_in_chunk,
+                                                    self.pattern,
+                                                    self.options.get_flags(),
+                                                    logical_op,
+                                                    strings,
+                                                    self._limit))
+                if not futures:
+                    break
+                done, futures = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    results.update(future.result())
+        for idx in idxs:
+            if idx not in results:
+                # Not searchable data, such as binary files, or data lacking
+                # the required literals
+                self._find_by_op(logical_op, data, idx)
+            elif logical_op == IF:
+                for line_span, match_span in results[idx]:
+                    self._log_match(idx,
+                                    (None, line_span, match_span, None),
+                                    self._get_source(data, idx))
+            elif logical_op == IFNOT and not results[idx]:
+                self._log_match(idx, (NULL, (-1, -1), (-1, -1), (-1, -1)))
+
+    def _get_chunks(self, data, idxs):
+        """
+        Split the data elements with the indices “idxs” that can be searched
+        by a worker process into chunks of indices, largest first. A data
+        element of at least self._CHUNK_SIZE chars makes a chunk on its own,
+        smaller ones are batched until they reach the size together.
+        """
+        sizes = [(idx, self._get_size(data, idx)) for idx in idxs
+                 if not self._is_mapped(idx) and
+                 not self._is_streamed(idx) and
+                 self._is_candidate(idx)]
+        sizes.sort(key=lambda x: x[1], reverse=True)
+        total = sum(x[1] for x in sizes)
+        # Aim for several chunks per worker to balance the load
+        chunk_size = max(min(self._CHUNK_SIZE, total // (self.workers * 4)), 1)
+        chunks = []
+        chunk = []
+        chunk_len = 0
+        for idx, size in sizes:
+            chunk.append(idx)
+            chunk_len += size
+            if chunk_len >= chunk_size:
+                chunks.append(chunk)
+                chunk = []
+                chunk_len = 0
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _get_size(self, data, idx):
+        """
+        Get the size of the data element with the index “idx” in chars. Files
+        not read yet in the lazy mode aren’t read, their size on disk is
+        used instead.
+        """
+        if (isinstance(data, _LazyContents) and
+            idx not in data._pinned and
+            idx not in data._cached):
+            try:
+                return os.path.getsize(self.files.paths[idx])
+            except OSError:
+                return 0
+        return len(data[idx]) if type(data[idx]) is str else 0
+
+    def _get_source(self, data, idx):
+        """
+        Get the source the lines of the results in the data element with
+        the index “idx” are extracted from (see MatchTable.append()). In the
+        lazy mode, it’s “data” itself, so the results don’t keep the contents
+        of all matching files in memory.
+        """
+        if isinstance(data, _LazyContents):
+            return data
+        return data[idx]
 
     def _find_by_op(self, logical_op, data, idx):
+        # Files with matches are found the same way as matches, only their
+        # number is limited
+        if logical_op == IFANY:
+            logical_op = IF
+        if not self._is_candidate(idx):
+            self.index_skips += 1
+            if logical_op == IFNOT:
+                self._log_match(idx, (NULL, (-1, -1), (-1, -1), (-1, -1)))
+            return
+        if self._is_mapped(idx):
+            self._find_mapped_by_op(logical_op, idx)
+            return
+        if self._is_streamed(idx):
+            self._find_streamed_by_op(logical_op, idx)
+            return
         if logical_op == IF:
-            res = self._find(data[idx])
+            res = self._find(data[idx], idx)
             for x in res:
-                self._log_match(idx, x)
+                self._log_match(idx, x, self._get_source(data, idx))
         if logical_op == IFNOT:
-            res = self._find_not(data[idx])
+            res = self._find_not(data[idx], idx)
             self._log_match(idx, res)
 
-    def _find(self, string):
-        if type(string) is not str:
+    def _is_candidate(self, idx):
+        """
+        Return False if self.index shows that the file with the index “idx”
+        can’t match the pattern.
+        """
+        if self._candidates is None or idx in self.files._content_changes_i:
+            return True
+        file_id = self.index._get_file_id(self.files.paths[idx])
+        return file_id is None or file_id in self._candidates
+
+    def _is_mapped(self, idx):
+        """
+        Return True if the file with the index “idx” should be searched using
+        memory mapping (see the class description).
+        """
+        if (self.options.data_type != FILECONTENT or
+            self.options.mmap_min_size is None or
+            not isinstance(self.files.contents, _LazyContents) or
+            idx in self.files._content_changes_i or
+            codecs.lookup(locale.getpreferredencoding(False)).name !=
+            "utf-8" or
+            os.path.splitext(self.files.paths[idx])[1].lower() in
+            _STREAM_OPENERS):
+            return False
+        try:
+            size = os.path.getsize(self.files.paths[idx])
+        except OSError:
+            return False
+        # Empty files can’t be mapped
+        return size > 0 and size >= self.options.mmap_min_size
+
+    def _find_mapped_by_op(self, logical_op, idx):
+        compiled = pattern_cache.get(self.pattern.encode(),
+                                     self.options.get_flags())
+        try:
+            with open(self.files.paths[idx], "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    # Lets the kernel drop pages that were already searched
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        buf.madvise(mmap.MADV_SEQUENTIAL)
+                    # Files stores binary files as BINARY, so they don’t
+                    # match
+                    if (_is_binary(buf[:Files._SNIFF_SIZE]) or
+                        not self._check_literals(buf)):
+                        res = None if logical_op == IF else True
+                    elif logical_op == IF:
+                        res = _find_in_mapped(compiled, buf, self._limit)
+                    else:
+                        res = compiled.search(buf) is None
+        except OSError:
+            return
+        if logical_op == IF:
+            # Lines of binary files can’t be decoded
+            for x in res or []:
+                self._log_match(idx, x)
+        elif res:
+            self._log_match(idx, (NULL, (-1, -1), (-1, -1), (-1, -1)))
+
+    def _is_streamed(self, idx):
+        """
+        Return True if the file with the index “idx” should be searched in
+        chunks (see the class description).
+        """
+        return (self.options.data_type == FILECONTENT and
+                self.options.chunk_size is not None and
+                isinstance(self.files.contents, _LazyContents) and
+                idx not in self.files._content_changes_i)
+
+    def _find_streamed_by_op(self, logical_op, idx):
+        # Binary files are treated as not matching
+        res = [] if logical_op == IF else True
+        try:
+            stream = _open_stream(self.files.paths[idx])
+            if stream is not None:
+                with stream:
+                    matches = _iter_stream_matches(self._compiled,
+                                                   stream,
+                                                   self.options.chunk_size,
+                                                   self._overlap)
+                    if logical_op == IF:
+                        res = list(itertools.islice(matches, self._limit))
+                    else:
+                        res = next(matches, None) is None
+        except (OSError, EOFError, lzma.LZMAError):
+            return
+        except UnicodeDecodeError:
+            pass
+        if logical_op == IF:
+            for x in res:
+                self._log_match(idx, x)
+        elif res:
+            self._log_match(idx, (NULL, (-1, -1), (-1, -1), (-1, -1)))
+
+    def _check_literals(self, data):
+        """
+        Return False if “data”, a string or a memory-mapped file, lacks a
+        literal required by the pattern, so it can’t match. Searching for
+        plain substrings is much faster than running the regex engine.
+        """
+        if not self._literals:
+            return True
+        self.prefilter_checks += 1
+        if not _has_literals(data, self._literals):
+            self.prefilter_skips += 1
+            return False
+        return True
+
+    def _find(self, string, idx):
+        if type(string) is not str or not self._check_literals(string):
             return [None]
         res = []
-        match_objs = re.finditer(self.pattern,
-                                 string,
-                                 self.options.get_flags())
+        line_ends = None
+        # With a limit, only a few lines are needed, so EOLs are counted up
+        # to the matches instead of indexing all lines of the string
+        counted = 0
+        eols = 0
+        match_objs = itertools.islice(self._compiled.finditer(string),
+                                      self._limit)
         counter = 0
         for i, match_obj in enumerate(match_objs):
             # Could be used to eliminate empty strings
             # if not match_obj.group(0):
             #    continue
-            line = self._get_line(match_obj.span(),
-                                  match_obj.group(0),
-                                  string)
-            line_span = self._get_line_span(match_obj.span()[0],
-                                            match_obj.group(0),
-                                            string)
-            res.append((line,
+            if self._limit is not None:
+                line, counted, eols = _count_line_number(string,
+                                                         match_obj.start(),
+                                                         counted,
+                                                         eols)
+                line_span = _get_match_line_span(line, match_obj.group(0))
+            else:
+                if line_ends is None:
+                    line_ends = self.files._get_line_ends(
+                        self.options.data_type,
+                        idx,
+                        string)
+                line_span = self._get_line_span(match_obj.span()[0],
+                                                match_obj.group(0),
+                                                line_ends)
+            # The line is extracted by self.match_info on first access
+            res.append((None,
                         line_span,
                         match_obj.span(),
-                        self._match_span_l))
+                        None))
             counter += 1
         if counter > 0:
             return res
         else:
             return [None]
 
-    def _find_not(self, string):
+    def _find_not(self, string, idx):
         """
-        Return None if the result obtained by the _find() method is True,
-        otherwise return specific null values as the find result.
+        Return None if “string” matches the pattern, otherwise return specific
+        null values as the find result. The search stops at the first match.
         """
-        if not self._find(string)[0]:
+        if (type(string) is not str or
+            not self._check_literals(string) or
+            self._compiled.search(string) is None):
             return (NULL, (-1, -1), (-1, -1), (-1, -1))
         else:
             return None
@@ -397,6 +2747,10 @@ class Replacer(_MatchInfo):
         self.files = finder.files
         self.options = finder.options
         self.repl = None
+        # An UndoJournal object set by the apply_sub() method
+        self.journal = None
+        # The row of finder.match_info of every row of self.match_info
+        self._rows = []
         
         # For now, it should only be changed for testing purposes
         self._allow_file_path = False
@@ -429,8 +2783,10 @@ class Replacer(_MatchInfo):
         if not self.finder.match_info or self.finder.logical_op == IFNOT:
             return
         self.repl = repl
-        self.match_info = []
+        self.match_info = MatchTable()
         self._data_i = []
+        self._rows = []
+        self._logged = {}
         self._replace_found_data((self.files.
                                   _get_data(
                                   self.options.
@@ -439,161 +2795,269 @@ class Replacer(_MatchInfo):
     # The method doesn’t manipulate data using the re module, instead it uses
     # information stored in self.match_info (see the _replace_found_data()
     # comment for some context)
-    def apply_sub(self, filter_list=[]):
+    def apply_sub(self, filter_list=()):
         """
         Apply data changes suggested by the replace() method. Only data change
-        suggestions not listed in “filter_list” are applied.
+        suggestions whose row indices in self.match_info are not listed in
+        “filter_list” are applied.
         If self.match_info is empty, the method returns None.
         After calling the method, the Replacer object became locked, which
         means that any new call to its public methods throws a RuntimeError.
         For new data manipulation, create a new Replacer object.
+        The applied changes are recorded in self.journal, an UndoJournal
+        object that can revert them.
         """
         if self._locked:
             raise RuntimeError("The Files object have already been modified. "
                                "Create a new Replacer object instead.")
         if not self.match_info:
             return
-        if len(self._data_i) == 1 or self._data_i[0] == self._data_i[1]:
-            prev_file_idx = self._data_i[0]
-        else:
-            prev_file_idx = -1
-        new_str = ""
-        prev_start_idx = 0
-        for i, idx in enumerate(self._data_i):
-            content = self.files._get_data(self.options.data_type)[idx]
-            finder_span = self.finder.match_info[i]["match_span"]
-            prematch_line = content[prev_start_idx:finder_span[0]]
-            replacer_span = self.match_info[i]["match_span_l"]
-            if i in filter_list:
-                match = content[finder_span[0]:finder_span[1]]
-            else:
-                match = (self.match_info
-                         [i]
-                         ["line"]
-                         [replacer_span[0]:replacer_span[1]])
-            prev_start_idx = finder_span[1]
-            b = False
-            new_str += prematch_line
-            new_str += match
-            if ((idx != prev_file_idx and
-                i != len(self._data_i) - 1 and
-                self._data_i[i] != self._data_i[i + 1]) or
-                (i == len(self._data_i) - 1 or
-                self._data_i[i] != self._data_i[i + 1])):
-                b = True
-            if b:
-                new_str += content[prev_start_idx:]
-                self.files._get_data(self.options.data_type)[idx] = new_str
-                self.files._log_change(self.options.data_type, idx)
-                new_str = ""
-                prev_start_idx = 0
-            prev_file_idx = idx
+        data = self.files._get_data(self.options.data_type)
+        filtered = set(filter_list)
+        # Every data element is rebuilt from its unchanged parts and the
+        # replacements in a single join, so the cost is linear in its size
+        journal = UndoJournal()
+        journal._data_type = self.options.data_type
+        rows = enumerate(self._data_i)
+        for idx, group in itertools.groupby(rows, key=lambda x: x[1]):
+            content = data[idx]
+            parts = []
+            prev_end = 0
+            # The length of the new data element so far
+            new_len = 0
+            spans = []
+            for i, _ in group:
+                start, end = self.finder.match_info._get(self._rows[i],
+                                                         "match_span")
+                parts.append(content[prev_end:start])
+                new_len += start - prev_end
+                if i in filtered:
+                    repl = content[start:end]
+                else:
+                    line = self.match_info._get(i, "line")
+                    span_l = self.match_info._get(i, "match_span_l")
+                    repl = line[span_l[0]:span_l[1]]
+                    if repl != content[start:end]:
+                        spans.append((new_len, content[start:end], repl))
+                parts.append(repl)
+                new_len += len(repl)
+                prev_end = end
+            parts.append(content[prev_end:])
+            data[idx] = "".join(parts)
+            self.files._log_change(self.options.data_type, idx)
+            if spans:
+                journal._entries.append((idx, self.files.paths[idx], spans))
+        self.journal = journal
         self._locked = True
 
-    # For the sake of filtering the results, multiple data change suggestions
-    # from one file must be appended to self.match_info without them knowing
-    # anything about each other. The method should also keep support for regex
-    # back-references, where the replacement string could always be different.
-    # As a consequence, things get somewhat complicated. Maybe storing more
-    # data in memory would be helpful, but the module’s objective is not to
-    # store any data that is not strictly necessary. For this reason, a rather
-    # complex attempt using the Replacer and Finder match_info attribute was
-    # finally held to accomplish the goals. Similarly, apply_sub() method is
-    # also more complicated than it has to be if different objectives were
-    # set.
+    def iter_diff(self, filter_list=(), context=3):
+        """
+        Yield the lines of a unified diff of the data changes suggested by
+        the replace() method, file by file. Suggestions whose row indices in
+        self.match_info are listed in “filter_list” are left out, the same
+        as by apply_sub(). Hunks show up to “context” unchanged lines.
+        The diff is made from the match spans rather than by comparing whole
+        files, and replaced files are never built, so even diffs of many
+        large files can be written out as they are generated, e.g. by
+        sys.stdout.writelines().
+        If the data of the Files object have already been modified, a
+        RuntimeError is raised.
+        """
+        if self._locked:
+            raise RuntimeError("The Files object have already been modified. "
+                               "Create a new Replacer object instead.")
+        data = self.files._get_data(self.options.data_type)
+        filtered = set(filter_list)
+        rows = enumerate(self._data_i)
+        for idx, group in itertools.groupby(rows, key=lambda x: x[1]):
+            changes = []
+            for i, _ in group:
+                if i in filtered:
+                    continue
+                span = self.finder.match_info._get(self._rows[i],
+                                                   "match_span")
+                line = self.match_info._get(i, "line")
+                span_l = self.match_info._get(i, "match_span_l")
+                changes.append((span[0], span[1], line[span_l[0]:span_l[1]]))
+            yield from _iter_unified_diff(self.files.paths[idx],
+                                          data[idx],
+                                          changes,
+                                          context)
+
+    # For the sake of filtering the results, every data change suggestion is
+    # logged as if it was the only one made to the data element, so its
+    # line shows just the one replacement. The rows of finder.match_info
+    # the rows of self.match_info come from are kept in self._rows, which
+    # apply_sub() relies on.
     def _replace_found_data(self, data):
-        is_group = False
-        # TODO: check also Python alternative backreference notation
-        if re.search("\\\\\d+", self.repl):
-            is_group = True
-        else:
-            repl_to_pass = self._get_repl_str(self.finder.match_info
-                                              [0]
-                                              ["line"],
-                                              self.finder.match_info
-                                              [0]
-                                              ["match_span_l"])
-        
-        for i, idx in enumerate(self.finder._data_i):
-            if is_group:
-                finder_span = self.finder.match_info[i]["match_span_l"]
-                finder_line = self.finder.match_info[i]["line"]
-                
-                pf_prematch = None
-                if (self.match_info and
-                    (self.finder.match_info[i]["idx"] ==
-                    self.finder.match_info[i - 1]["idx"]) and
-                    (self.finder.match_info[i]["line_span"] == 
-                    self.finder.match_info[i - 1]["line_span"])):
-                    pr_span = (self.match_info
-                               [len(self.match_info) - 1]
-                               ["match_span_l"])
-                    pf_span = self.finder.match_info[i - 1]["match_span_l"]
-                    pr_line = (self.match_info
-                               [len(self.match_info) - 1]
-                               ["line"])
-                    pf_line = self.finder.match_info[i - 1]["line"]
-                    pf_prematch = pf_line[:pf_span[1]]
-                    
-                    finder_line = pr_line
-                    finder_line = pr_line[pr_span[1]:]
-                repl_line = re.sub(self.finder.pattern,
-                                   self.repl,
-                                   finder_line,
-                                   flags=self.options.get_flags(),
-                                   count=1)
-                if pf_prematch:
-                    repl_line = pf_prematch + repl_line
-                    finder_line = pf_prematch + finder_line
-                repl_to_pass = self._get_repl_str(finder_line,
-                                                  finder_span,
-                                                  repl_line)
-            
-            finder_span = self.finder.match_info[i]["match_span"]
-            content = data[idx]
-            prestr = content[:finder_span[0]]
-            midstr = content[finder_span[0]:finder_span[1]]
-            sufstr = content[finder_span[1]:]
-            string = prestr + repl_to_pass + sufstr
-            if string is not data[idx]:
-                spans = self._get_match_spans(i, repl_to_pass)
-                match_span = spans[0]
-                match_span_l = spans[1]
-                line = self._get_line(match_span, repl_to_pass, string)
-                line_span = self._get_line_span(match_span[0],
-                                                repl_to_pass,
-                                                string)
-                self._log_match(idx, (line,
-                                      line_span,
-                                      match_span,
-                                      match_span_l))
-
-    def _get_repl_str(self, match_line, match_span, repl_line=None):
-        """
-        Get a replacement string by applying the re module sub() method to
-        “match_line” and then extracting it using “match_span”. “repl_line”
-        could be passed to omit replacing inside the method.
-        """
-        if not repl_line:
-            repl_line = re.sub(self.finder.pattern,
-                               self.repl,
-                               match_line,
-                               flags=self.options.get_flags(),
-                               count=1)
-        prematch = match_line[:match_span[0]]
-        postmatch = match_line[match_span[1]:]
-        new_repl = repl_line.replace(prematch, "", 1)
-        new_repl = new_repl[::-1].replace(postmatch[::-1], "", 1)
-        return new_repl[::-1]
-
-    def _get_match_spans(self, idx, repl):
-        """
-        Get both the span indices of the replacement string “repl” located
-        inside the data element with the index “idx” and the span indices of
-        the replacement string located inside the replaced line of the same
-        data element.
-        """
-        span = self.finder.match_info[idx]["match_span"]
-        span2 = self.finder.match_info[idx]["match_span_l"]
-        return ((span[0], span[0] + len(repl)),
-                (span2[0], span2[0] + len(repl)))
+        data_type = self.options.data_type
+        compiled = pattern_cache.get(self.finder.pattern,
+                                     self.options.get_flags())
+        rows = enumerate(self.finder._data_i)
+        for idx, group in itertools.groupby(rows, key=lambda x: x[1]):
+            string = data[idx]
+            # Matches found in binary files, e.g. in streamed compressed
+            # ones, can’t be replaced
+            if type(string) is not str:
+                continue
+            finder_rows = [row for row, _ in group]
+            spans = [self.finder.match_info._get(row, "match_span")
+                     for row in finder_rows]
+            line_ends = self.files._get_line_ends(data_type, idx, string)
+            for row, (span, match_obj) in zip(finder_rows,
+                                              _iter_spanned_matches(compiled,
+                                                                    string,
+                                                                    spans)):
+                # Back-references are expanded from the match itself, so
+                # the replacement never depends on the rest of the line
+                if match_obj is None:
+                    repl = string[span[0]:span[1]]
+                else:
+                    repl = match_obj.expand(self.repl)
+                line, match_span_l = _extract_replaced_line(span,
+                                                            repl,
+                                                            string)
+                line_span = self._get_line_span(span[0], repl, line_ends)
+                self.match_info.append(idx,
+                                       self.files.paths[idx],
+                                       line,
+                                       line_span,
+                                       (span[0], span[0] + len(repl)),
+                                       match_span_l)
+                self._data_i.append(idx)
+                self._rows.append(row)
+
+
+class UndoJournal:
+    """
+    A record of the data changes applied by the apply_sub() method of a
+    Replacer object, which stores it in Replacer.journal. Only the replaced
+    spans are kept, with their offsets inside the changed data elements and
+    both the original and the new text, so the journal takes about as much
+    memory as a diff of the changes. If “path” is given, the journal is
+    loaded from the SQLite database file if it exists, and the save() method
+    stores the journal there. A journal that can’t be loaded is empty.
+    The changes can be reverted in a Files object by the revert() method or
+    in the saved files by the revert_files() method. A data element is only
+    reverted if it still contains the new text at all recorded spans.
+    """
+
+    # Incremented whenever the format of saved journals changes
+    _VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self._data_type = FILECONTENT
+        # (idx, path, [(start, original, new)]) of every changed data element
+        self._entries = []
+        state = _read_database(path,
+                               self._VERSION,
+                               ["SELECT data_type FROM journal",
+                                "SELECT entry, idx, path FROM entries "
+                                "ORDER BY entry",
+                                "SELECT entry, start, original, new "
+                                "FROM spans ORDER BY rowid"])
+        if state is not None and state[0]:
+            journal_rows, entries_rows, spans_rows = state
+            spans = {}
+            for entry, *span in spans_rows:
+                spans.setdefault(entry, []).append(tuple(span))
+            self._data_type = journal_rows[0][0]
+            self._entries = [(idx, path, spans.get(entry, []))
+                             for entry, idx, path in entries_rows]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def revert(self, files):
+        """
+        Revert the recorded changes in “files”, the Files object they were
+        applied to. Reverted data elements are logged as changed, so the
+        save() method of “files” writes them back to disk.
+        The method returns a list of paths whose data element couldn’t be
+        reverted, because it was changed again.
+        """
+        data = files._get_data(self._data_type)
+        failed_paths = []
+        for idx, path, spans in self._entries:
+            if idx >= len(data):
+                failed_paths.append(path)
+                continue
+            content = _revert_spans(data[idx], spans)
+            if content is None:
+                failed_paths.append(path)
+                continue
+            data[idx] = content
+            files._log_change(self._data_type, idx)
+        return failed_paths
+
+    def revert_files(self, workers=1):
+        """
+        Revert the recorded changes in the files on disk, after they were
+        saved. The files are read and written the same way as by a Files
+        object, with “workers” passed to its save() method. Changes made to
+        file paths aren’t saved to disk, so they are never reverted.
+        The method returns a list of files that couldn’t be reverted, because
+        they were changed again or due to an OSError.
+        """
+        if self._data_type != FILECONTENT:
+            return []
+        files = Files()
+        failed_paths = []
+        for _, path, spans in self._entries:
+            content = files._read_file(path)
+            if type(content) is str:
+                content = _revert_spans(content, spans)
+            if type(content) is not str:
+                failed_paths.append(path)
+                continue
+            files.paths.append(path)
+            files.contents.append(content)
+        files._content_changes_i = list(range(len(files.paths)))
+        return failed_paths + files.save(workers)
+
+    def save(self, path=None):
+        """
+        Save the journal to “path” or, if it isn’t given, to self.path. The
+        previous journal file is replaced only when the new one is completely
+        written. Raise ValueError if neither path is set.
+        """
+        path = path or self.path
+        if not path:
+            raise ValueError("No path to save the journal to")
+        _write_database(path,
+                        self._VERSION,
+                        [("journal",
+                          "data_type INTEGER",
+                          [(self._data_type,)]),
+                         ("entries",
+                          "entry INTEGER, idx INTEGER, path TEXT",
+                          ((entry, idx, path)
+                           for entry, (idx, path, _)
+                           in enumerate(self._entries))),
+                         ("spans",
+                          "entry INTEGER, start INTEGER, original TEXT, "
+                          "new TEXT",
+                          ((entry, *span)
+                           for entry, (_, _, spans)
+                           in enumerate(self._entries)
+                           for span in spans))])
+
+
+def _revert_spans(string, spans):
+    """
+    Get “string” with the new text of every (start, original, new) tuple of
+    “spans” replaced by the original one or None if the new text isn’t
+    found at its offset.
+    """
+    parts = []
+    prev_end = 0
+    for start, original, new in spans:
+        end = start + len(new)
+        if string[start:end] != new:
+            return None
+        parts.append(string[prev_end:start])
+        parts.append(original)
+        prev_end = end
+    parts.append(string[prev_end:])
+    return "".join(parts)
@@ -0,0 +1,189 @@
+"""
+Rough timing of the regex module on synthetic data. Run it from the tests
+directory with “python3 ./bench_regex.py”.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, "../")
+
+from bregex import regex
+
+
+def _time(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_find_single_line():
+    for size in (1, 5, 10):
+        files = regex.Files()
+        files.paths = ["path1"]
+        files.contents = ["x" * (size * 1000000) + "foo" + "y" * 1000]
+        finder = regex.Finder(files, regex.Options())
+        secs = _time(finder.find, regex.IF, "foo")
+        print(f"find in a single {size} MB line: {secs:.4f} s")
+        # Lines are extracted on first access
+        secs = _time(lambda: finder.match_info[0]["line"])
+        print(f"extract a single {size} MB line: {secs:.4f} s")
+
+
+def bench_set_workers():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for i in range(2000):
+            with open(os.path.join(tmp_dir, f"{i}.txt"), "w") as f:
+                f.write("foo bar baz\n" * 1000)
+        for workers in (1, 4, 16):
+            files = regex.Files()
+            secs = _time(files.set, tmp_dir, False, workers)
+            mb = sum(len(x) for x in files.contents) / 1000000
+            print(f"set with {workers} workers: {secs:.4f} s "
+                  f"({mb / secs:.1f} MB/s)")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_set_binary():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for i in range(20):
+            with open(os.path.join(tmp_dir, f"{i}.bin"), "wb") as f:
+                f.write(b"\x89PNG\r\n\x1a\n\0" + os.urandom(5000000))
+            with open(os.path.join(tmp_dir, f"{i}.txt"), "w") as f:
+                f.write("foo bar baz\n" * 1000)
+        files = regex.Files()
+        secs = _time(files.set, tmp_dir, False)
+        print(f"set with 100 MB of binary files: {secs:.4f} s")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_find_many():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for i in range(200):
+            with open(os.path.join(tmp_dir, f"{i}.txt"), "w") as f:
+                f.write(f"foo{i} bar baz\n" * 20000)
+        # The cache holds only a few files, as with a corpus larger than
+        # memory
+        files = regex.Files(lazy=True, max_bytes=4 * 1024 * 1024)
+        files.set(tmp_dir, False)
+        patterns = [f"bar{i}" for i in range(50)]
+
+        def find_each():
+            for pattern in patterns:
+                regex.Finder(files, regex.Options()).find(regex.IF, pattern)
+
+        secs = _time(find_each)
+        print(f"find {len(patterns)} patterns one by one: {secs:.4f} s")
+        finder = regex.Finder(files, regex.Options())
+        secs = _time(finder.find_many, regex.IF, patterns)
+        print(f"find {len(patterns)} patterns with find_many(): {secs:.4f} s")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_find_index():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for i in range(5000):
+            with open(os.path.join(tmp_dir, f"{i}.txt"), "w") as f:
+                f.write(f"foo{i} bar baz\n" * 2000)
+        files = regex.Files()
+        files.set(tmp_dir, False)
+        index = regex.TrigramIndex()
+        secs = _time(index.update, files)
+        print(f"index 5000 files: {secs:.4f} s")
+        for name, idx in [("without", None), ("with", index)]:
+            finder = regex.Finder(files, regex.Options(), index=idx)
+            secs = _time(finder.find, regex.IF, r"foo123\b")
+            print(f"find {name} an index: {secs:.4f} s")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_set_cache():
+    tmp_dir = tempfile.mkdtemp()
+    db_path = tmp_dir + ".db"
+    try:
+        for i in range(2000):
+            with open(os.path.join(tmp_dir, f"{i}.txt"), "w") as f:
+                f.write("foo bar baz\n" * 1000)
+        for run in ("first", "second"):
+            cache = regex.FileCache(db_path)
+            secs = _time(regex.Files(cache=cache).set, tmp_dir, False)
+            cache.close()
+            print(f"set with a cache, {run} run: {secs:.4f} s")
+    finally:
+        shutil.rmtree(tmp_dir)
+        os.remove(db_path)
+
+
+def bench_apply_sub():
+    files = regex.Files()
+    files.paths = ["path1"]
+    files.contents = ["foo bar foo bar foo bar foo bar foo bar\n" * 20000]
+    finder = regex.Finder(files, regex.Options())
+    finder.find(regex.IF, "foo")
+    replacer = regex.Replacer(finder)
+    secs = _time(replacer.replace, "baz")
+    print(f"replace {len(replacer.match_info)} matches in a file: {secs:.4f} s")
+    secs = _time(replacer.apply_sub, set(range(0, 100000, 2)))
+    print(f"apply_sub to half of them: {secs:.4f} s")
+
+
+def bench_save():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for i in range(2000):
+            with open(os.path.join(tmp_dir, f"{i}.txt"), "w") as f:
+                f.write("foo bar baz\n" + "bar baz\n" * 1000)
+        for workers in (1, 8):
+            files = regex.Files()
+            files.set(tmp_dir, False)
+            finder = regex.Finder(files, regex.Options())
+            finder.find(regex.IF, "^foo|^qux")
+            replacer = regex.Replacer(finder)
+            replacer.replace("qux" if workers == 1 else "foo")
+            replacer.apply_sub()
+            files.save(workers)
+            mb = files.saved_bytes / 1000000
+            print(f"save 2000 files with {workers} workers: "
+                  f"{files.save_seconds:.4f} s ({mb:.1f} MB)")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_iter_diff():
+    files = regex.Files()
+    files.paths = [f"path{i}" for i in range(10000)]
+    files.contents = ["foo bar baz\n" * 100 + "qux\n" + "foo bar baz\n" * 100
+                      for _ in files.paths]
+    finder = regex.Finder(files, regex.Options())
+    finder.find(regex.IF, "qux")
+    replacer = regex.Replacer(finder)
+    replacer.replace("quux")
+
+    def write_diff():
+        with open(os.devnull, "w") as f:
+            f.writelines(replacer.iter_diff())
+
+    secs = _time(write_diff)
+    print(f"diff of 10000 changed files: {secs:.4f} s")
+
+
+if __name__ == "__main__":
+    bench_find_single_line()
+    bench_set_workers()
+    bench_set_binary()
+    bench_find_many()
+    bench_find_index()
+    bench_set_cache()
+    bench_apply_sub()
+    bench_save()
+    bench_iter_diff()
@@ -1,4 +1,6 @@
 import unittest
+import difflib
+import gzip
 import re
 import shutil
 import os
@@ -19,6 +21,34 @@ class TestOptions(unittest.TestCase):
         self.assertEqual(options.get_flags(), re.IGNORECASE|re.MULTILINE)
 
 
+class TestPatternCache(unittest.TestCase):
+
+    def test_get(self):
+        cache = regex.PatternCache()
+        pattern = cache.get("foo", re.IGNORECASE)
+        self.assertEqual(pattern.pattern, "foo")
+        self.assertEqual(pattern.flags & re.IGNORECASE, re.IGNORECASE)
+        self.assertIs(cache.get("foo", re.IGNORECASE), pattern)
+        self.assertIsNot(cache.get("foo"), pattern)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_get_evicts_least_recently_used(self):
+        cache = regex.PatternCache(2)
+        foo = cache.get("foo")
+        cache.get("bar")
+        cache.get("foo")
+        cache.get("baz")
+        self.assertIs(cache.get("foo"), foo)
+        cache.get("bar")
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_get_invalid_pattern(self):
+        cache = regex.PatternCache()
+        with self.assertRaises(re.error):
+            cache.get("(foo")
+        self.assertEqual(len(cache._patterns), 0)
+
+
 class TestFiles(unittest.TestCase):
 
     @classmethod
@@ -64,7 +94,7 @@ class TestFiles(unittest.TestCase):
 
     def test_set_file_return_value(self):
         res = self.files.set("./data_tmp/prague_16th_century_drawings/savery.txt", False)
-        self.assertEqual(res, [True, []])
+        self.assertEqual(res, [True, [], []])
 
     def test_set_file_recursively(self):
         path = "./data_tmp/prague_16th_century_drawings/savery.txt"
@@ -92,6 +122,14 @@ class TestFiles(unittest.TestCase):
         self.assertEqual(self.files.paths, self._get_paths(path) + self._get_paths(path2))
         self.assertEqual(self.files.contents, self._get_content(path) + self._get_content(path2))
 
+    def test_set_multiple_calls_unsorted_dirs(self):
+        path = "./data_tmp/prague_16th_century_drawings/prague_castle"
+        path2 = "./data_tmp/prague_16th_century_drawings/lesser_town_square"
+        self.files.set(path, False)
+        self.files.set(path2, False)
+        self.assertEqual(self.files.paths, self._get_paths(path) + self._get_paths(path2))
+        self.assertEqual(self.files.contents, self._get_content(path) + self._get_content(path2))
+
     def test_set_multiple_calls_duplicated_file(self):
         path = "./data_tmp/prague_16th_century_drawings/lesser_town_square"
         path2 = "./data_tmp/prague_16th_century_drawings/lesser_town_square/savery.txt"
@@ -108,6 +146,57 @@ class TestFiles(unittest.TestCase):
         self.assertEqual(self.files.paths, self._get_paths(path))
         self.assertEqual(self.files.contents, self._get_content(path))
 
+    def test_set_dir_recursively_concurrently(self):
+        path = "./data_tmp/prague_16th_century_drawings"
+        res = self.files.set(path, True, 4)
+        self.assertEqual(res, [True, [], []])
+        self.assertEqual(self.files.paths, self._get_paths(path))
+        self.assertEqual(self.files.contents, self._get_content(path))
+
+    def test_set_unreadable_file(self):
+        path = "./data_tmp/prague_16th_century_drawings/prague_castle"
+        paths = self._get_paths(path)
+        self.files._read_file = lambda x: None if x == paths[1] else open(x).read()
+        res = self.files.set(path, False, 2)
+        self.assertEqual(res, [True, [paths[1]], []])
+        self.assertEqual(self.files.paths, [paths[0], paths[2]])
+        self.assertEqual(self.files.contents, [self._get_content(path)[0], self._get_content(path)[2]])
+
+    def test_set_binary_files(self):
+        path = "./data_tmp/test_binary"
+        os.mkdir(path)
+        for name, data in [("a.bin", b"foo\0bar" * 10000),
+                           ("b.bin", b"\xff\xfefoo"),
+                           ("c.bin", b"a" * 9000 + b"\xff"),
+                           ("d.txt", b"a" * 8191 + "é".encode())]:
+            with open(os.path.join(path, name), "wb") as f:
+                f.write(data)
+        res = self.files.set(path, False)
+        self.assertEqual(res, [True, [], [os.path.join(path, x) for x in ["a.bin", "b.bin", "c.bin"]]])
+        self.assertEqual(self.files.contents, [regex.BINARY] * 3 + ["a" * 8191 + "é"])
+
+    def test_set_dir_symlink_loop(self):
+        path = "./data_tmp/test_symlink_loop"
+        os.makedirs(os.path.join(path, "foo"))
+        with open(os.path.join(path, "foo", "bar.txt"), "w") as f:
+            f.write("bar")
+        os.symlink("..", os.path.join(path, "foo", "loop"))
+        self.files.set(path, True)
+        self.assertEqual(self.files.paths, [os.path.join(path, "foo", "bar.txt")])
+        self.assertEqual(self.files.contents, ["bar"])
+
+    def test_set_dir_hard_link(self):
+        path = "./data_tmp/test_hard_link"
+        os.mkdir(path)
+        with open(os.path.join(path, "bar.txt"), "w") as f:
+            f.write("bar")
+        os.link(os.path.join(path, "bar.txt"), os.path.join(path, "baz.txt"))
+        os.link(os.path.join(path, "bar.txt"), os.path.join(path, "abc.txt"))
+        os.symlink("bar.txt", os.path.join(path, "aaa.txt"))
+        self.files.set(path, False)
+        self.assertEqual(self.files.paths, [os.path.join(path, "abc.txt")])
+        self.assertEqual(self.files.contents, ["bar"])
+
     def test_set_trailing_slash(self):
         wrong_path = "./data_tmp/prague_16th_century_drawings/savery.txt/"
         path = "./data_tmp/prague_16th_century_drawings/savery.txt"
@@ -122,7 +211,7 @@ class TestFiles(unittest.TestCase):
 
     def test_set_invalid_path_return_value(self):
         res = self.files.set("./foo/bar", False)
-        self.assertEqual(res, [False, []])
+        self.assertEqual(res, [False, [], []])
 
     def test_set_forbid_relative_path(self):
         self.files._allow_relative_path = False
@@ -133,7 +222,50 @@ class TestFiles(unittest.TestCase):
     def test_set_forbid_relative_path_return_value(self):
         self.files._allow_relative_path = False
         res = self.files.set("./foo/bar", False)
-        self.assertEqual(res, [False, []])
+        self.assertEqual(res, [False, [], []])
+
+    def test_set_lazy(self):
+        path = "./data_tmp/prague_16th_century_drawings"
+        self.files = regex.Files(lazy=True)
+        res = self.files.set(path, True)
+        self.assertEqual(res, [True, [], []])
+        self.assertEqual(len(self.files.contents._cached), 0)
+        self.assertEqual(self.files.paths, self._get_paths(path))
+        self.assertEqual(self.files.contents, self._get_content(path))
+
+    def test_set_lazy_max_bytes(self):
+        path = "./data_tmp/prague_16th_century_drawings"
+        self.files = regex.Files(lazy=True, max_bytes=1)
+        self.files.set(path, True)
+        options = regex.Options()
+        finder = regex.Finder(self.files, options)
+        finder.find(regex.IF, "Prague")
+        self.assertEqual(len(self.files.contents._cached), 1)
+        self.assertEqual(len(finder.match_info), 8)
+
+    def test_set_lazy_max_bytes_results(self):
+        path = "./data_tmp/prague_16th_century_drawings"
+        self.files.set(path, True)
+        finder = regex.Finder(self.files, regex.Options())
+        finder.find(regex.IF, "Prague")
+        for workers in [1, 2]:
+            files = regex.Files(lazy=True, max_bytes=1)
+            files.set(path, True)
+            finder2 = regex.Finder(files, regex.Options(), workers=workers)
+            finder2.find(regex.IF, "Prague")
+            self.assertFalse(any(type(x) is str
+                                 for x in finder2.match_info._sources.values()))
+            self.assertEqual(len(files.contents._cached), 1)
+            self.assertEqual(finder2.match_info, finder.match_info)
+
+    def test_remove_files_lazy(self):
+        path = "./data_tmp/prague_16th_century_drawings/prague_castle"
+        self.files = regex.Files(lazy=True)
+        self.files.set(path, False)
+        self.files.contents[2]
+        self.files.remove([0, 1])
+        self.assertEqual(self.files.paths, self._get_paths(path)[2:])
+        self.assertEqual(self.files.contents, self._get_content(path)[2:])
 
     def test_remove_files(self):
         path = "./data_tmp/prague_16th_century_drawings/prague_castle"
@@ -178,11 +310,446 @@ class TestFiles(unittest.TestCase):
             content = f.read()
         self.assertEqual(content, "baz bar")
 
+    def test_save_workers(self):
+        old_path = "./data_tmp/prague_16th_century_drawings/savery.txt"
+        dir_path = "./data_tmp/test_save_workers"
+        os.mkdir(dir_path)
+        for i in range(10):
+            shutil.copy(old_path, os.path.join(dir_path, f"{i}.txt"))
+        os.chmod(os.path.join(dir_path, "0.txt"), 0o640)
+        self.files.set(dir_path, False)
+        finder = regex.Finder(self.files, regex.Options())
+        replacer = regex.Replacer(finder)
+        finder.find(regex.IF, "Prague")
+        replacer.replace("Praha")
+        replacer.apply_sub()
+        self.assertEqual(self.files.save(4), [])
+        self.assertEqual(sorted(os.listdir(dir_path)), sorted(f"{i}.txt" for i in range(10)))
+        self.assertEqual(os.stat(os.path.join(dir_path, "0.txt")).st_mode & 0o777, 0o640)
+        with open(os.path.join(dir_path, "9.txt"), "r") as f:
+            content = f.read()
+        self.assertEqual(content, self.read_files[old_path].replace("Prague", "Praha"))
+        self.assertEqual(self.files.saved_bytes, sum(len(x.encode()) for x in self.files.contents))
+
+    def test_save_hard_link(self):
+        old_path = "./data_tmp/prague_16th_century_drawings/savery.txt"
+        path = "./data_tmp/test_save_hard_link/foo.txt"
+        os.mkdir(os.path.dirname(path))
+        shutil.copy(old_path, path)
+        os.link(path, path + ".link")
+        inode = os.stat(path).st_ino
+        self.files.set(path, False)
+        finder = regex.Finder(self.files, regex.Options())
+        replacer = regex.Replacer(finder)
+        finder.find(regex.IF, "Prague")
+        replacer.replace("Praha")
+        replacer.apply_sub()
+        self.assertEqual(self.files.save(), [])
+        self.assertEqual(os.stat(path).st_ino, inode)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))), ["foo.txt", "foo.txt.link"])
+        with open(path + ".link", "r") as f:
+            content = f.read()
+        self.assertEqual(content, self.read_files[old_path].replace("Prague", "Praha"))
+
+    def test_save_failed(self):
+        old_path = "./data_tmp/prague_16th_century_drawings/savery.txt"
+        path = "./data_tmp/test_save_failed/foo.txt"
+        os.mkdir(os.path.dirname(path))
+        shutil.copy(old_path, path)
+        self.files.set(path, False)
+        self.files.contents = ["foo bar \udc80"]
+        finder = regex.Finder(self.files, regex.Options())
+        replacer = regex.Replacer(finder)
+        finder.find(regex.IF, "foo")
+        replacer.replace("baz")
+        replacer.apply_sub()
+        self.assertEqual(self.files.save(), [path])
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["foo.txt"])
+        with open(path, "r") as f:
+            content = f.read()
+        self.assertEqual(content, self.read_files[old_path])
+
+    def test_save_lazy(self):
+        old_path = "./data_tmp/prague_16th_century_drawings/savery.txt"
+        path = "./data_tmp/test_save_lazy/foo.txt"
+        os.mkdir(os.path.dirname(path))
+        shutil.copy(old_path, path)
+        self.files = regex.Files(lazy=True, max_bytes=1)
+        self.files.set(path, False)
+        options = regex.Options()
+        finder = regex.Finder(self.files, options)
+        replacer = regex.Replacer(finder)
+        finder.find(regex.IF, "Prague")
+        replacer.replace("Praha")
+        replacer.apply_sub()
+        self.assertEqual(list(self.files.contents._pinned), [0])
+        self.files.save()
+        self.assertEqual(self.files.contents._pinned, {})
+        with open(path, "r") as f:
+            content = f.read()
+        self.assertEqual(content, self.read_files[old_path].replace("Prague", "Praha"))
+
     @classmethod
     def tearDownClass(self):
         shutil.rmtree("./data_tmp")
 
 
+class TestFinderMapped(unittest.TestCase):
+
+    def setUp(self):
+        os.mkdir("./data_mmap_tmp")
+        self.path = "./data_mmap_tmp/foo.txt"
+        with open(self.path, "w", encoding="utf-8", newline="") as f:
+            f.write("Praha, Prag\r\nPrague\nPrága\r\nSavery’s Prague")
+
+    def _find(self, logical_op, pattern, mmap_min_size):
+        files = regex.Files(lazy=True)
+        files.set(self.path, False)
+        finder = regex.Finder(files, regex.Options(mmap_min_size=mmap_min_size))
+        finder.find(logical_op, pattern)
+        return files, finder
+
+    def test_find(self):
+        files, finder = self._find(regex.IF, "Pra(gu)?e", 0)
+        self.assertEqual(files.contents._cached, {})
+        self.assertEqual(finder.match_info, self._find(regex.IF, "Pra(gu)?e", None)[1].match_info)
+        self.assertEqual([x["match_span"] for x in finder.match_info], [(12, 18), (34, 40)])
+        self.assertEqual([x["line"] for x in finder.match_info], ["Prague", "Savery’s Prague"])
+
+    def test_find_small_file(self):
+        files, finder = self._find(regex.IF, "Prague", 1000)
+        self.assertEqual(len(files.contents._cached), 1)
+        self.assertEqual(len(finder.match_info), 2)
+
+    def test_find_if_not_operator(self):
+        self.assertEqual(self._find(regex.IFNOT, "Prague", 0)[1].match_info, [])
+        self.assertEqual(len(self._find(regex.IFNOT, "Paris", 0)[1].match_info), 1)
+
+    def test_find_not_lazy(self):
+        files = regex.Files()
+        files.set(self.path, False)
+        finder = regex.Finder(files, regex.Options(mmap_min_size=0))
+        finder.find(regex.IF, "Prag\n")
+        self.assertEqual([x["match_span"] for x in finder.match_info], [(7, 12)])
+
+    def test_find_binary(self):
+        with open("./data_mmap_tmp/foo.bin", "wb") as f:
+            f.write(b"\0\0 Prague")
+        self.path = "./data_mmap_tmp"
+        files, finder = self._find(regex.IF, "Prague", 0)
+        self.assertEqual({x["path"] for x in finder.match_info}, {"./data_mmap_tmp/foo.txt"})
+        self.assertEqual(len(self._find(regex.IFNOT, "Prague", 0)[1].match_info), 1)
+        replacer = regex.Replacer(finder)
+        replacer.replace("Praha")
+        self.assertEqual(len(replacer.match_info), 2)
+
+    def tearDown(self):
+        shutil.rmtree("./data_mmap_tmp")
+
+
+class TestFinderStreamed(unittest.TestCase):
+
+    def setUp(self):
+        os.mkdir("./data_stream_tmp")
+        self.text = "Praha, Prag\nPrague\n\nPrága\nSavery’s Prague\n" * 50
+        with open("./data_stream_tmp/foo.txt", "w") as f:
+            f.write(self.text)
+        with gzip.open("./data_stream_tmp/foo.txt.gz", "wt") as f:
+            f.write(self.text)
+        with open("./data_stream_tmp/foo.bin", "wb") as f:
+            f.write(b"\xff\xfePrague")
+
+    def _find(self, logical_op, pattern, chunk_size, path="./data_stream_tmp"):
+        files = regex.Files(lazy=True)
+        files.set(path, False)
+        finder = regex.Finder(files, regex.Options(chunk_size=chunk_size, chunk_overlap=0))
+        finder.find(logical_op, pattern)
+        return files, finder
+
+    def test_find(self):
+        for pattern in ["Pra(gu)?e", "^$", "(?<=, )Pr.g", "a\nP", "g[ua]"]:
+            files, finder = self._find(regex.IF, pattern, 7, "./data_stream_tmp/foo.txt")
+            self.assertEqual(files.contents._cached, {})
+            self.assertEqual(finder.match_info, self._find(regex.IF, pattern, None, "./data_stream_tmp/foo.txt")[1].match_info)
+
+    def test_find_compressed(self):
+        files, finder = self._find(regex.IF, "Savery’s", 7)
+        self.assertEqual([x["path"] for x in finder.match_info], ["./data_stream_tmp/foo.txt"] * 50 + ["./data_stream_tmp/foo.txt.gz"] * 50)
+        self.assertEqual(finder.match_info[0]["line"], "Savery’s Prague")
+
+    def test_find_if_not_operator(self):
+        files, finder = self._find(regex.IFNOT, "Prague", 7)
+        self.assertEqual([x["path"] for x in finder.match_info], ["./data_stream_tmp/foo.bin"])
+
+    def test_find_binary(self):
+        with open("./data_stream_tmp/foo.dat", "wb") as f:
+            f.write(b"\0\0 Prague")
+        files, finder = self._find(regex.IF, "Prague", 7)
+        self.assertNotIn("./data_stream_tmp/foo.dat", [x["path"] for x in finder.match_info])
+        replacer = regex.Replacer(finder)
+        replacer.replace("Praha")
+        self.assertEqual([x["path"] for x in replacer.match_info], ["./data_stream_tmp/foo.txt"] * 100)
+        replacer.apply_sub()
+        self.assertEqual(files.contents[2], self.text.replace("Prague", "Praha"))
+
+    def test_find_not_lazy(self):
+        files = regex.Files()
+        files.set("./data_stream_tmp", False)
+        finder = regex.Finder(files, regex.Options(chunk_size=7))
+        finder.find(regex.IF, "Savery’s")
+        self.assertEqual([x["path"] for x in finder.match_info], ["./data_stream_tmp/foo.txt"] * 50)
+
+    def tearDown(self):
+        shutil.rmtree("./data_stream_tmp")
+
+
+class TestTrigramIndex(unittest.TestCase):
+
+    def setUp(self):
+        os.mkdir("./data_index_tmp")
+        for name, content in [("a.txt", "def foo_bar():"), ("b.txt", "def bar():"), ("c.txt", "foo")]:
+            with open(os.path.join("./data_index_tmp", name), "w") as f:
+                f.write(content)
+        self.files = regex.Files()
+        self.files.set("./data_index_tmp", False)
+        self.db_path = "./data_index_tmp.db"
+        self.index = regex.TrigramIndex(self.db_path)
+        self.index.update(self.files)
+
+    def _find(self, logical_op, pattern, index):
+        finder = regex.Finder(self.files, regex.Options(), index=index)
+        finder.find(logical_op, pattern)
+        return finder
+
+    def test_find(self):
+        for logical_op in [regex.IF, regex.IFNOT]:
+            for pattern in [r"def\s+foo_\w+", "bar", "o", "(?i)FOO"]:
+                self.assertEqual(self._find(logical_op, pattern, self.index).match_info,
+                                 self._find(logical_op, pattern, None).match_info)
+        self.assertEqual(self._find(regex.IF, r"def\s+foo_\w+", self.index).index_skips, 2)
+        self.assertEqual(self._find(regex.IF, "o", self.index).index_skips, 0)
+
+    def _dump(self, index):
+        return [index._connection.execute(x).fetchall() for x in ["SELECT path, size, mtime_ns, inode FROM files ORDER BY path",
+                                                                   "SELECT trigram, path FROM postings JOIN files USING (file_id) ORDER BY trigram, path"]]
+
+    def test_save_and_load(self):
+        self.index.save()
+        index = regex.TrigramIndex(self.db_path)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(self._dump(index), self._dump(self.index))
+        self.assertEqual(self._find(regex.IF, "bar", index).index_skips, 1)
+        index.close()
+
+    def test_save_path(self):
+        index = regex.TrigramIndex()
+        index.update(self.files)
+        self.assertRaises(ValueError, index.save)
+        index.save(self.db_path)
+        self.index.close()
+        self.index = regex.TrigramIndex(self.db_path)
+        self.assertEqual(self._dump(self.index), self._dump(index))
+
+    def test_not_saved(self):
+        self.index.close()
+        self.index = regex.TrigramIndex(self.db_path)
+        self.assertEqual(len(self.index), 0)
+
+    def test_load_unreadable(self):
+        self.index.close()
+        for content in [b"\x80\x04K\x01.", b"SQLite format 3\0garbage"]:
+            with open(self.db_path, "wb") as f:
+                f.write(content)
+            index = regex.TrigramIndex(self.db_path)
+            self.assertEqual(len(index), 0)
+            self.assertEqual(self._find(regex.IF, "bar", index).index_skips, 0)
+            index.update(self.files)
+            index.save()
+            with open(self.db_path, "rb") as f:
+                self.assertNotEqual(f.read(), content)
+        self.index = regex.TrigramIndex(self.db_path)
+        self.assertEqual(len(self.index), 3)
+
+    def test_update(self):
+        with open("./data_index_tmp/c.txt", "w") as f:
+            f.write("foo bar baz")
+        os.remove("./data_index_tmp/a.txt")
+        self.files = regex.Files()
+        self.files.set("./data_index_tmp", False)
+        self.index.update(self.files)
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index._get_candidates(["bar"]), {self.index._get_file_id(x) for x in self.files.paths})
+        self.assertEqual(self.index._get_candidates(["foo_"]), set())
+        index = regex.TrigramIndex()
+        index.update(self.files)
+        self.assertEqual(self._dump(self.index), self._dump(index))
+        self.assertEqual(self.index._connection.execute("SELECT COUNT(*) FROM postings").fetchone()[0],
+                         index._connection.execute("SELECT COUNT(*) FROM postings").fetchone()[0])
+
+    def test_unsaved_changes(self):
+        self.files.contents[2] = "foo_bar"
+        self.files._log_change(regex.FILECONTENT, 2)
+        self.assertEqual(len(self._find(regex.IF, "foo_bar", self.index).match_info), 2)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree("./data_index_tmp")
+        os.remove(self.db_path)
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        os.mkdir("./data_cache_tmp")
+        for name, content in [("a.txt", b"foo\nbar"), ("b.txt", b"baz"), ("c.bin", b"\0")]:
+            with open(os.path.join("./data_cache_tmp", name), "wb") as f:
+                f.write(content)
+        self.db_path = "./data_cache_tmp.db"
+
+    def _set(self):
+        cache = regex.FileCache(self.db_path)
+        files = regex.Files(cache=cache)
+        files.set("./data_cache_tmp", False)
+        return files, cache
+
+    def test_set(self):
+        files, cache = self._set()
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+        cache.close()
+        files2, cache2 = self._set()
+        self.assertEqual((cache2.hits, cache2.misses), (3, 0))
+        self.assertEqual(files2.contents, files.contents)
+        self.assertEqual(files2.contents[2], regex.BINARY)
+        cache2.close()
+
+    def test_set_changed_file(self):
+        self._set()[1].close()
+        with open("./data_cache_tmp/b.txt", "w") as f:
+            f.write("qux qux")
+        files, cache = self._set()
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertEqual(files.contents[1], "qux qux")
+        cache.close()
+
+    def test_set_lazy_committed_after_find(self):
+        cache = regex.FileCache(self.db_path)
+        files = regex.Files(lazy=True, cache=cache)
+        files.set("./data_cache_tmp", False)
+        finder = regex.Finder(files, regex.Options())
+        finder.find(regex.IF, "bar")
+        # The rows are visible to another connection before close()
+        files2, cache2 = self._set()
+        self.assertEqual((cache2.hits, cache2.misses), (3, 0))
+        cache2.close()
+        cache.close()
+
+    def test_line_ends(self):
+        files, cache = self._set()
+        finder = regex.Finder(files, regex.Options())
+        finder.find(regex.IF, "bar")
+        self.assertEqual(list(cache.get_line_ends(files.paths[0], regex._get_fingerprint(files.paths[0]))), [4, 7])
+        cache.close()
+        files, cache = self._set()
+        finder = regex.Finder(files, regex.Options())
+        finder.find(regex.IF, "bar")
+        self.assertEqual(finder.match_info[0]["line_span"], (2, 3))
+        cache.close()
+
+    def tearDown(self):
+        shutil.rmtree("./data_cache_tmp")
+        os.remove(self.db_path)
+
+
+class TestFilesWatcher(unittest.TestCase):
+
+    def setUp(self):
+        os.mkdir("./data_watch_tmp")
+        for name, content in [("a.txt", "foo"), ("b.txt", "bar"), ("c.txt", "foo bar")]:
+            self._write(name, content)
+        self.files = regex.Files()
+        self.files.set("./data_watch_tmp", False)
+        self.finder = regex.Finder(self.files, regex.Options())
+        self.finder.find(regex.IF, "foo")
+
+    def _write(self, name, content):
+        with open(os.path.join("./data_watch_tmp", name), "w") as f:
+            f.write(content)
+
+    def _test_poll(self, use_inotify):
+        watcher = regex.FilesWatcher(self.files, self.finder, use_inotify)
+        self.assertEqual(watcher.poll(), [])
+        self._write("b.txt", "foo foo")
+        self._write("c.txt", "bar bar")
+        self.assertEqual(watcher.poll(), [1, 2])
+        self.assertEqual(self.files.contents, ["foo", "foo foo", "bar bar"])
+        self.assertEqual([(x["idx"], x["match_span"]) for x in self.finder.match_info], [(0, (0, 3)), (1, (0, 3)), (1, (4, 7))])
+        self.assertEqual(self.finder._data_i, [0, 1, 1])
+        self.assertEqual(watcher.poll(), [])
+        watcher.close()
+
+    def test_poll(self):
+        self._test_poll(False)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "requires inotify")
+    def test_poll_inotify(self):
+        self._test_poll(True)
+
+    def test_poll_unsaved_changes(self):
+        watcher = regex.FilesWatcher(self.files, self.finder, False)
+        self.files.contents[0] = "baz"
+        self.files._log_change(regex.FILECONTENT, 0)
+        self._write("a.txt", "qux qux")
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(self.files.contents[0], "baz")
+
+    def _test_poll_saved_changes(self, use_inotify):
+        watcher = regex.FilesWatcher(self.files, self.finder, use_inotify)
+        self.files.contents[0] = "baz"
+        self.files._log_change(regex.FILECONTENT, 0)
+        self.assertEqual(self.files.save(), [])
+        self.assertEqual(self.files._content_changes_i, [])
+        self.assertEqual(watcher.poll(), [])
+        self._write("a.txt", "qux qux")
+        self.assertEqual(watcher.poll(), [0])
+        self.assertEqual(self.files.contents[0], "qux qux")
+        watcher.close()
+
+    def test_poll_saved_changes(self):
+        self._test_poll_saved_changes(False)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "requires inotify")
+    def test_poll_saved_changes_inotify(self):
+        self._test_poll_saved_changes(True)
+
+    def tearDown(self):
+        shutil.rmtree("./data_watch_tmp")
+
+
+class TestMatchTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = regex.MatchTable()
+        self.table.append(0, "path1", "foo bar", (1, 2), (4, 7), (4, 7))
+        self.table.append(2, "path3", regex.NULL, (-1, -1), (-1, -1), (-1, -1))
+
+    def test_row_access(self):
+        self.assertEqual(len(self.table), 2)
+        self.assertEqual(self.table[0]["path"], "path1")
+        self.assertEqual(self.table[0]["match_span"], (4, 7))
+        self.assertEqual(self.table[-1]["line"], regex.NULL)
+        with self.assertRaises(IndexError):
+            self.table[2]
+        with self.assertRaises(KeyError):
+            self.table[0]["foo"]
+
+    def test_compare_to_list(self):
+        self.assertEqual(self.table, [
+            {"idx": 0, "path": "path1", "line": "foo bar", "line_span": (1, 2), "match_span": (4, 7), "match_span_l": (4, 7)},
+            {"idx": 2, "path": "path3", "line": regex.NULL, "line_span": (-1, -1), "match_span": (-1, -1), "match_span_l": (-1, -1)}])
+        self.assertNotEqual(self.table, [])
+        self.assertEqual(regex.MatchTable(), [])
+
+
 class TestFinder(unittest.TestCase):
 
     def setUp(self):
@@ -214,6 +781,133 @@ class TestFinder(unittest.TestCase):
         self.assertEqual([x["line"] for x in finder.match_info], [regex.NULL])
         self.assertEqual([x["path"] for x in finder.match_info], ["path1"])
 
+    def test_find_required_literals(self):
+        self.assertEqual(regex._get_required_literals(re.compile(r"def\s+foo_\w+")), ["foo_", "def"])
+        self.assertEqual(regex._get_required_literals(re.compile(r"(ab)+c?de|f")), [])
+        self.assertEqual(regex._get_required_literals(re.compile(r"(ab)+c?de")), ["ab", "de"])
+        self.assertEqual(regex._get_required_literals(re.compile(r"foo", re.IGNORECASE)), [])
+
+    def test_find_prefilter(self):
+        self.files.paths = ["path1", "path2", "path3"]
+        self.files.contents = ["def foo_bar", "def bar", "define foo_"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IF, r"def\s+foo_\w+")
+        self.assertEqual([x["path"] for x in finder.match_info], ["path1"])
+        self.assertEqual((finder.prefilter_checks, finder.prefilter_skips), (3, 1))
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IFNOT, r"def\s+foo_\w+")
+        self.assertEqual([x["path"] for x in finder.match_info], ["path2", "path3"])
+
+    def test_find_file_if_any_operator(self):
+        self.files.paths = ["path1", "path2", "path3"]
+        self.files.contents = ["foo foo", "bar", "bar\nfoo bar foo"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IFANY, "foo")
+        self.assertEqual([(x["path"], x["line"], x["match_span"]) for x in finder.match_info], [("path1", "foo foo", (0, 3)), ("path3", "foo bar foo", (4, 7))])
+        self.assertEqual([x["line_span"] for x in finder.match_info], [(1, 2), (2, 3)])
+        # The line index isn’t built for a single match
+        self.assertEqual(self.files._line_ends, {})
+
+    def test_find_file_if_not_operator_short_circuit(self):
+        self.files.paths = ["path1", "path2"]
+        self.files.contents = ["foo\nfoo", "bar"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IFNOT, "foo")
+        self.assertEqual([x["path"] for x in finder.match_info], ["path2"])
+        self.assertEqual(self.files._line_ends, {})
+
+    def test_find_max_matches(self):
+        self.files.paths = ["path1", "path2", "path3"]
+        self.files.contents = ["foo foo foo", "bar", "foo foo"]
+        for workers in [1, 2]:
+            finder = regex.Finder(self.files, self.options, workers=workers, max_matches_per_file=2)
+            finder.find(regex.IF, "foo")
+            self.assertEqual([(x["idx"], x["match_span"]) for x in finder.match_info], [(0, (0, 3)), (0, (4, 7)), (2, (0, 3)), (2, (4, 7))])
+        finder = regex.Finder(self.files, self.options, workers=2, max_matches=4)
+        finder.find(regex.IF, "foo")
+        self.assertEqual([x["idx"] for x in finder.match_info], [0, 0, 0, 2])
+        self.assertEqual(finder._data_i, [0, 0, 0, 2])
+        finder = regex.Finder(self.files, self.options, max_matches=1)
+        finder.find(regex.IFNOT, "foo")
+        self.assertEqual(len(finder.match_info), 1)
+
+    def test_find_max_matches_line_span(self):
+        self.files.paths = ["path1"]
+        self.files.contents = ["a\r\nfoo\n\nbar foo\u2028foo\n"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IF, "foo|\n$")
+        expected = [x["line_span"] for x in finder.match_info]
+        finder = regex.Finder(self.files, regex.Options(), max_matches_per_file=10)
+        finder.find(regex.IF, "foo|\n$")
+        self.assertEqual([x["line_span"] for x in finder.match_info], expected)
+        self.assertEqual(expected, [(2, 3), (4, 5), (5, 6), (5, 6)])
+
+    def test_find_many_max_matches(self):
+        self.files.paths = ["path1", "path2", "path3"]
+        self.files.contents = ["foo foo foo", "bar", "foo foo"]
+        finder = regex.Finder(self.files, self.options, max_matches=4)
+        res = finder.find_many(regex.IF, ["foo", "bar"])
+        self.assertEqual([x["idx"] for x in res["foo"]], [0, 0, 0, 2])
+        self.assertEqual(len(res["bar"]), 1)
+        res = regex.Finder(self.files, self.options, max_matches=1).find_many(regex.IFNOT, ["qux"])
+        self.assertEqual(len(res["qux"]), 1)
+
+    def test_iter_matches(self):
+        self.files.paths = ["path1", "path2", "path3", "path4"]
+        self.files.contents = ["foo\nbar foo", "bar", regex.BINARY, "baz foo"]
+        for logical_op in [regex.IF, regex.IFNOT]:
+            finder = regex.Finder(self.files, self.options)
+            finder.find(logical_op, "foo")
+            self.assertEqual(list(regex.Finder(self.files, self.options).iter_matches(logical_op, "foo")), finder.match_info)
+        finder = regex.Finder(self.files, self.options)
+        matches = finder.iter_matches(regex.IF, "foo")
+        self.assertEqual(next(matches)["line"], "foo")
+        matches.close()
+        self.assertEqual(finder.match_info, [])
+        self.assertEqual(list(finder.iter_matches(regex.IF, "")), [])
+
+    def test_find_after_iter_matches(self):
+        self.files.paths = ["path1", "path2", "path3"]
+        self.files.contents = ["foo qux", "bar qux", "foo"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IF, "foo")
+        self.assertEqual([x["path"] for x in finder.iter_matches(regex.IF, "qux")], ["path1"])
+        self.assertEqual([x["path"] for x in finder.match_info], ["path1", "path3"])
+        self.assertEqual(finder.pattern, "foo")
+        finder.find(regex.IF, "qux")
+        self.assertEqual([x["path"] for x in finder.match_info], ["path1"])
+        finder = regex.Finder(self.files, self.options)
+        list(finder.iter_matches(regex.IF, "foo"))
+        finder.find(regex.IF, "qux")
+        self.assertEqual([x["path"] for x in finder.match_info], ["path1", "path2"])
+
+    def test_find_many(self):
+        self.files.paths = ["path1", "path2", "path3", "path4"]
+        self.files.contents = ["foo\nbar foo", "bar", regex.BINARY, "baz foo"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IF, "foo")
+        match_info = finder.match_info
+        patterns = ["ba.", "foo$", "qux", ""]
+        for logical_op in [regex.IF, regex.IFNOT]:
+            res = finder.find_many(logical_op, patterns)
+            self.assertEqual(list(res), patterns)
+            for pattern in patterns[:-1]:
+                expected = regex.Finder(self.files, self.options, finder)
+                expected.find(logical_op, pattern)
+                self.assertEqual(res[pattern], expected.match_info)
+            self.assertEqual(res[""], [])
+        self.assertIs(finder.match_info, match_info)
+
+    def test_find_many_combined_patterns(self):
+        compiled = [re.compile("fo(o)"), re.compile("(?P<x>b)a(?P=x)")]
+        self.assertIsNone(regex._combine_patterns(compiled, 0))
+        self.assertEqual(regex._combine_patterns(compiled[:1] + [re.compile("ba(r)")], 0).pattern, "(?:fo(o))|(?:ba(r))")
+        self.assertIsNone(regex._combine_patterns([re.compile("foo"), re.compile("(?i)bar")], 0))
+        self.files.paths = ["path1", "path2"]
+        self.files.contents = ["bab", "baba"]
+        res = regex.Finder(self.files, self.options).find_many(regex.IF, ["(b)a\\1", "(a)b\\1"])
+        self.assertEqual([len(x) for x in res.values()], [2, 1])
+
     def test_find_file_one_file_multiple_results(self):
         self.files.paths = ["path1"]
         self.files.contents = ["foo bar foo"]
@@ -276,6 +970,19 @@ class TestFinder(unittest.TestCase):
         self.assertEqual([x["line"] for x in finder2.match_info], ["foo bar"])
         self.assertEqual([x["path"] for x in finder2.match_info], ["path3"])
 
+    def test_find_file_multiple_objects_no_duplicates(self):
+        self.files.paths = ["path1", "path2"]
+        self.files.contents = ["foo foo\nfoo", "bar"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IF, "foo")
+        finder2 = regex.Finder(self.files, self.options, finder)
+        finder2.find(regex.IF, "o\\b")
+        self.assertEqual(finder2.match_info, [
+            {"idx": 0, "path": "path1", "line": "foo foo", "line_span": (1, 2), "match_span": (2, 3), "match_span_l": (2, 3)},
+            {"idx": 0, "path": "path1", "line": "foo foo", "line_span": (1, 2), "match_span": (6, 7), "match_span_l": (6, 7)},
+            {"idx": 0, "path": "path1", "line": "foo", "line_span": (2, 3), "match_span": (10, 11), "match_span_l": (2, 3)}])
+        self.assertEqual(finder2._data_i, [0, 0, 0])
+
     def test_find_file_multiple_objects_if_not_operator(self):
         self.files.paths = ["path1", "path2", "path3"]
         self.files.contents = ["foo", "bar", "foo bar baz"]
@@ -305,6 +1012,24 @@ class TestFinder(unittest.TestCase):
         self.assertEqual([x["line"] for x in finder.match_info], ["foo"])
         self.assertEqual([x["path"] for x in finder.match_info], ["path2"])
 
+    def test_find_file_parallel(self):
+        self.files.paths = ["path1", "path2", "path3", "path4", "path5"]
+        self.files.contents = ["foo\nbar foo", "bar", regex.BINARY, "x" * 1000 + "\nfoo", "foofoo"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IF, "foo")
+        finder2 = regex.Finder(self.files, self.options, workers=2)
+        finder2.find(regex.IF, "foo")
+        self.assertEqual(finder2.match_info, finder.match_info)
+        self.assertEqual(finder2._data_i, finder._data_i)
+
+    def test_find_file_parallel_if_not_operator(self):
+        self.files.paths = ["path1", "path2", "path3", "path4"]
+        self.files.contents = ["foo", "bar", regex.BINARY, "baz"]
+        finder = regex.Finder(self.files, self.options, workers=2)
+        finder.find(regex.IFNOT, "foo")
+        self.assertEqual([x["line"] for x in finder.match_info], [regex.NULL] * 3)
+        self.assertEqual([x["path"] for x in finder.match_info], ["path2", "path3", "path4"])
+
     def test_find_file_invalid_pattern(self):
         self.files.paths = ["path1", "path2", "path3"]
         self.files.contents = ["foo", "bar", "foo bar"]
@@ -376,6 +1101,23 @@ class TestFinder(unittest.TestCase):
         self.assertEqual([x["line"] for x in finder.match_info], ["foo\n"])
         self.assertEqual([x["path"] for x in finder.match_info], ["path1"])
 
+    def test_find_file_long_line(self):
+        self.files.paths = ["path1"]
+        self.files.contents = ["a\n" + "x" * 100000 + "foo" + "y" * 1000 + "\r\nb"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IF, "foo")
+        self.assertEqual([x["line"] for x in finder.match_info], ["x" * 100000 + "foo" + "y" * 1000])
+        self.assertEqual([x["match_span_l"] for x in finder.match_info], [(100000, 100003)])
+
+    def test_find_line_extracted_on_access(self):
+        self.files.paths = ["path1"]
+        self.files.contents = ["foo\nbar baz"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IF, "baz")
+        self.assertEqual(finder.match_info._lines, [None])
+        self.assertEqual(finder.match_info[0]["match_span_l"], (4, 7))
+        self.assertEqual(finder.match_info._lines, ["bar baz"])
+
     def test_find_line_span(self):
         self.files.paths = ["path1", "path2"]
         self.files.contents = ["bar", "foo\nbar"]
@@ -404,6 +1146,16 @@ class TestFinder(unittest.TestCase):
         finder.find(regex.IF, "\nb\na\nr")
         self.assertEqual([x["line_span"] for x in finder.match_info], [(3, 7)])
 
+    def test_find_line_span_contents_changed(self):
+        self.files.paths = ["path1"]
+        self.files.contents = ["foo\nbar"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IF, "bar")
+        self.files.contents = ["foo\n\nbar"]
+        finder = regex.Finder(self.files, self.options)
+        finder.find(regex.IF, "bar")
+        self.assertEqual([x["line_span"] for x in finder.match_info], [(3, 4)])
+
     def test_find_line_span_if_not_operator(self):
         self.files.paths = ["path1", "path2", "path3"]
         self.files.contents = ["foo", "bar", "foo bar"]
@@ -507,6 +1259,65 @@ class TestReplacer(unittest.TestCase):
         self.replacer.replace("baz")
         self.assertEqual([x["match_span"] for x in self.replacer.match_info], [(0, 3), (4, 7)])
 
+    def test_replace_using_named_group(self):
+        self.files.paths = ["path1"]
+        self.files.contents = ["foo1 foo2"]
+        self.finder = regex.Finder(self.files, self.options)
+        self.finder.find(regex.IF, "foo(?P<n>\\d)")
+        self.replacer = regex.Replacer(self.finder)
+        self.replacer.replace("\\g<n>bar")
+        self.assertEqual([x["line"] for x in self.replacer.match_info], ["1bar foo2", "foo1 2bar"])
+        self.assertEqual([x["match_span"] for x in self.replacer.match_info], [(0, 4), (5, 9)])
+
+    def test_replace_adjacent_empty_matches(self):
+        self.files.paths = ["path1"]
+        self.files.contents = ["ab"]
+        self.finder = regex.Finder(self.files, self.options)
+        self.finder.find(regex.IF, "b*")
+        self.replacer = regex.Replacer(self.finder)
+        self.replacer.replace("-")
+        self.assertEqual([x["line"] for x in self.replacer.match_info], ["-ab", "a-", "ab-"])
+        self.replacer.apply_sub()
+        self.assertEqual(self.files.contents, ["-a--"])
+
+    def test_iter_diff(self):
+        self.files.paths = ["path1", "path2"]
+        self.files.contents = ["".join(f"foo{i}\n" for i in range(20)), "bar"]
+        self.finder = regex.Finder(self.files, self.options)
+        self.finder.find(regex.IF, "foo(1|9)$|bar")
+        self.replacer = regex.Replacer(self.finder)
+        self.replacer.replace("baz\\1")
+        old_contents = list(self.files.contents)
+        diff = list(self.replacer.iter_diff())
+        self.replacer.apply_sub()
+        expected = []
+        for path, old, new in zip(self.files.paths, old_contents, self.files.contents):
+            expected.extend(difflib.unified_diff(old.splitlines(True), new.splitlines(True), path, path))
+        # difflib doesn’t mark missing EOL chars
+        expected[-2:] = ["-bar\n\\ No newline at end of file\n", "+baz\n\\ No newline at end of file\n"]
+        self.assertEqual(diff, expected)
+
+    def test_iter_diff_joined_lines(self):
+        self.files.paths = ["path1"]
+        self.files.contents = ["foo\nbar\nbaz\n"]
+        self.finder = regex.Finder(self.files, self.options)
+        self.finder.find(regex.IF, "o\n|a")
+        self.replacer = regex.Replacer(self.finder)
+        self.replacer.replace("")
+        diff = list(self.replacer.iter_diff([2], context=0))
+        self.assertEqual(diff, ["--- path1\n", "+++ path1\n", "@@ -1,2 +1 @@\n", "-foo\n", "-bar\n", "+fobr\n"])
+
+    def test_iter_diff_after_apply_sub(self):
+        self.files.paths = ["path1"]
+        self.files.contents = ["foo"]
+        self.finder = regex.Finder(self.files, self.options)
+        self.finder.find(regex.IF, "foo")
+        self.replacer = regex.Replacer(self.finder)
+        self.replacer.replace("bar")
+        self.replacer.apply_sub()
+        with self.assertRaises(RuntimeError):
+            list(self.replacer.iter_diff())
+
     def test_apply_sub(self):
         self.files.paths = ["path1", "path2", "path3"]
         self.files.contents = ["foo", "bar", "bar foo bar"]
@@ -600,6 +1411,83 @@ class TestReplacer(unittest.TestCase):
         self.replacer.apply_sub([0, 2])
         self.assertEqual(self.files.contents, ["foo", "bar", "baz bar foo"])
 
+    def test_apply_sub_using_filter_set(self):
+        self.files.paths = ["path1", "path2"]
+        self.files.contents = ["foo foo foo", "foo"]
+        self.finder = regex.Finder(self.files, self.options)
+        self.finder.find(regex.IF, "foo")
+        self.replacer = regex.Replacer(self.finder)
+        self.replacer.replace("baz")
+        self.replacer.apply_sub({1, 3})
+        self.assertEqual(self.files.contents, ["baz foo baz", "foo"])
+        self.assertEqual(self.files._content_changes_i, [0, 1])
+
+
+
+class TestUndoJournal(unittest.TestCase):
+
+    def setUp(self):
+        os.mkdir("./data_journal_tmp")
+        for name, content in [("a.txt", "foo bar\nfoo"), ("b.txt", "bar"), ("c.txt", "a foo")]:
+            with open(os.path.join("./data_journal_tmp", name), "w") as f:
+                f.write(content)
+        self.files = regex.Files()
+        self.files.set("./data_journal_tmp", False)
+        self.old_contents = list(self.files.contents)
+        finder = regex.Finder(self.files, regex.Options())
+        finder.find(regex.IF, "fo(o)")
+        self.replacer = regex.Replacer(finder)
+        self.replacer.replace("\\1\\1\\1")
+        self.replacer.apply_sub([1])
+
+    def _read(self):
+        contents = []
+        for path in self.files.paths:
+            with open(path, "r") as f:
+                contents.append(f.read())
+        return contents
+
+    def test_journal(self):
+        self.assertEqual(self.files.contents, ["ooo bar\nfoo", "bar", "a ooo"])
+        self.assertEqual(self.replacer.journal._entries, [(0, self.files.paths[0], [(0, "foo", "ooo")]),
+                                                          (2, self.files.paths[2], [(2, "foo", "ooo")])])
+
+    def test_revert(self):
+        self.assertEqual(self.replacer.journal.revert(self.files), [])
+        self.assertEqual(self.files.contents, self.old_contents)
+
+    def test_revert_changed_again(self):
+        self.files.contents[2] = "a foo"
+        self.assertEqual(self.replacer.journal.revert(self.files), [self.files.paths[2]])
+        self.assertEqual(self.files.contents, self.old_contents)
+
+    def test_revert_files(self):
+        self.files.save()
+        self.assertEqual(self._read(), ["ooo bar\nfoo", "bar", "a ooo"])
+        self.replacer.journal.path = "./data_journal_tmp/journal"
+        self.replacer.journal.save()
+        journal = regex.UndoJournal("./data_journal_tmp/journal")
+        self.assertEqual(journal._entries, self.replacer.journal._entries)
+        with open(self.files.paths[0], "w") as f:
+            f.write("qux")
+        self.assertEqual(journal.revert_files(), [self.files.paths[0]])
+        self.assertEqual(self._read(), ["qux", "bar", "a foo"])
+
+    def test_save_path(self):
+        self.assertRaises(ValueError, self.replacer.journal.save)
+        self.replacer.journal.save("./data_journal_tmp/journal")
+        journal = regex.UndoJournal("./data_journal_tmp/journal")
+        self.assertEqual(journal._entries, self.replacer.journal._entries)
+
+    def test_load_unreadable(self):
+        with open("./data_journal_tmp/journal", "wb") as f:
+            f.write(b"\x80\x04K\x01.")
+        journal = regex.UndoJournal("./data_journal_tmp/journal")
+        self.assertEqual(len(journal), 0)
+        self.assertEqual(journal.revert_files(), [])
+
+    def tearDown(self):
+        shutil.rmtree("./data_journal_tmp")
 
 if __name__ == "__main__":
     unittest.main()